@@ -0,0 +1,133 @@
+"""
+Calibration
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import numpy as np
+
+def robust_mean(samples, threshold=3.0):
+    """
+    Returns the mean of the rows of samples, leaving out rows with any column further than threshold robust standard
+    deviations (estimated from the median absolute deviation) from that column's median, such as frames with a blink
+    or a missed pupil. Falls back to the median when every row is left out
+    """
+
+    samples = np.atleast_2d(np.asarray(samples, dtype=np.double))
+    median = np.median(samples, axis=0)
+
+    spread = 1.4826 * np.median(np.abs(samples - median), axis=0)     # Scaled to match the standard deviation for normal noise
+    spread[spread < 1e-12] = np.inf     # A column that never varies rejects nothing
+
+    inliers = np.all(np.abs(samples - median) <= threshold * spread, axis=1)
+
+    if not np.any(inliers):
+        return median
+
+    return samples[inliers].mean(axis=0)
+
+def get_calibration_grid(width, height, dots):
+    """
+    Returns the centers of a dots by dots grid of cells covering the screen as a (dots * dots, 2) array of pixels,
+    in the same row by row order as the full calibration
+    """
+
+    columns = (np.arange(dots * dots) % dots + 0.5) * (width / dots)
+    rows = (np.arange(dots * dots) // dots + 0.5) * (height / dots)
+
+    return np.column_stack((columns, rows))
+
+class AdaptiveCalibration():
+    """
+    Chooses calibration dots one at a time from a dots by dots grid, and decides when calibration can stop.
+
+    Each dot goes where the fit so far is least certain. Until there are held out residuals, that is the unused grid
+    point with the highest leverage under a quadratic surface in screen coordinates fit to the dots already shown
+    (x' (X'X + regularization I)^-1 x), which stands in for the gaze model since the features at a point are not
+    known before the user looks at it. This starts from the corners and then fills the largest gaps. Once add_error()
+    is given the per-dot residuals, the leverage is scaled up near the dots that were missed by the most: by the sum
+    of their squared residuals, relative to all of them, weighted by a Gaussian of their distance whose width is
+    about one grid cell. Calibration is done once at least min_dots have been shown and the cross-validated error is
+    at most target_error pixels, or when the grid runs out
+    """
+
+    def __init__(self, width, height, dots=4, target_error=50, min_dots=5, regularization=1e-3):
+        self.width = width
+        self.height = height
+        self.target_error = target_error
+        self.min_dots = min_dots
+        self.regularization = regularization
+        self.spread = 1 / dots  # Width of the residual weighting, as a fraction of the screen
+
+        self.candidates = get_calibration_grid(width, height, dots)
+        self._terms = self._expand(self.candidates)
+
+        self.reset()
+
+    def reset(self):
+        self._used = np.zeros(len(self.candidates), dtype=bool)
+        self.errors = []
+        self._residuals = None     # (points, residuals) from the latest add_error()
+
+    def _expand(self, points):
+        # Centered and scaled so every term is of a similar size
+        u = points[:, 0] / self.width - 0.5
+        v = points[:, 1] / self.height - 0.5
+
+        return np.column_stack((np.ones(len(points)), u, v, u * u, u * v, v * v))
+
+    def get_dot_count(self):
+        return int(np.count_nonzero(self._used))
+
+    def next_point(self):
+        """
+        Returns the (x, y) in pixels of the next dot to show and marks it used, or None when every grid point was shown
+        """
+
+        if np.all(self._used):
+            return None
+
+        shown = self._terms[self._used]
+        normal = shown.T @ shown + self.regularization * np.eye(shown.shape[1])
+        leverage = np.einsum("ij,ji->i", self._terms, np.linalg.solve(normal, self._terms.T))
+
+        if self._residuals is not None:
+            leverage *= 1 + self._get_residual_weights(*self._residuals)
+
+        leverage[self._used] = -np.inf
+
+        index = int(np.argmax(leverage))
+        self._used[index] = True
+
+        return float(self.candidates[index, 0]), float(self.candidates[index, 1])
+
+    def _get_residual_weights(self, points, residuals):
+        # Squared residual of each dot, spread over the candidates around it and normalized by the total
+        squared = residuals ** 2
+        total = squared.sum()
+
+        if total <= 0:
+            return np.zeros(len(self.candidates))
+
+        offsets = (self.candidates[:, None, :] - points[None, :, :]) / (self.width, self.height)
+        closeness = np.exp(-np.sum(offsets ** 2, axis=2) / (2 * self.spread ** 2))
+
+        return closeness @ squared / total
+
+    def add_error(self, error, points=None, residuals=None):
+        """
+        Records the cross-validated error in pixels after the latest dot (None if there is none yet) and returns
+        whether calibration is done. points and residuals, the dots' positions and how far in pixels each was missed
+        (see GazeEstimation.get_residuals()), steer the next dots towards where the fit is worst
+        """
+
+        self.errors.append(error)
+
+        if points is not None and residuals is not None and len(residuals) > 0:
+            self._residuals = (np.asarray(points, dtype=np.double), np.asarray(residuals, dtype=np.double))
+
+        if np.all(self._used):
+            return True
+
+        return self.get_dot_count() >= self.min_dots and error is not None and error <= self.target_error
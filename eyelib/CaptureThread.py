@@ -0,0 +1,74 @@
+"""
+Capture Thread
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import threading
+import time
+
+class CaptureThread():
+    """
+    Continuously reads frames from a capture device on a background thread, keeping only the newest one in a
+    single slot. Readers always get the latest frame, and any frames they never saw are counted as dropped
+    """
+
+    def __init__(self, cap, retry_delay=0.005):
+        self._cap = cap
+        self._retry_delay = retry_delay
+
+        self._condition = threading.Condition()
+        self._image = None
+        self._timestamp = 0
+        self._sequence = 0
+        self._last_read_sequence = 0
+        self._dropped_frames = 0
+        self._running = True
+
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        while self._running:
+            ret, image = self._cap.read()
+            timestamp = time.perf_counter()
+
+            if not ret:
+                time.sleep(self._retry_delay)   # Give the driver a moment instead of spinning on a failed read
+                continue
+
+            with self._condition:
+                self._image = image
+                self._timestamp = timestamp
+                self._sequence += 1
+                self._condition.notify_all()
+
+    def read(self, timeout=None):
+        """
+        Waits for a frame newer than the last one read and returns (ret, image, timestamp, sequence).
+        The timestamp is the time.perf_counter() value taken right after the frame was grabbed
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence > self._last_read_sequence or not self._running, timeout)
+
+            if self._sequence <= self._last_read_sequence:
+                return False, None, 0, 0
+
+            self._dropped_frames += self._sequence - self._last_read_sequence - 1
+            self._last_read_sequence = self._sequence
+
+            return True, self._image, self._timestamp, self._sequence
+
+    def get_dropped_frames(self):
+        return self._dropped_frames
+
+    def release(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+
+        self._thread.join()
+        self._cap.release()
@@ -0,0 +1,73 @@
+"""
+Debug Overlay
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import threading
+import time
+import cv2
+
+from .FeatureExtraction import draw_feature_state
+
+class DebugOverlay():
+    """
+    Shows the tracked features over the camera image in a HighGUI window, drawn on its own thread.
+    submit() hands over copies of at most max_fps frames per second and ignores the rest, so the tracking
+    thread never waits on drawing or imshow
+    """
+
+    def __init__(self, max_fps=10, window_name="img"):
+        self._interval = 1 / max_fps
+        self._window_name = window_name
+
+        self._condition = threading.Condition()
+        self._pending = None
+        self._last_submit_time = 0
+        self._running = True
+
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, image, state):
+        """
+        Queues a frame and its feature state for display if the rate cap allows it, returning whether it was taken
+        """
+
+        now = time.perf_counter()
+
+        if image is None or now - self._last_submit_time < self._interval:
+            return False
+
+        self._last_submit_time = now
+
+        with self._condition:
+            self._pending = (image.copy(), state.copy())    # The tracking thread keeps reusing its own buffers
+            self._condition.notify()
+
+        return True
+
+    def run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending is not None or not self._running)
+
+                if not self._running:
+                    break
+
+                image, state = self._pending
+                self._pending = None
+
+            cv2.imshow(self._window_name, draw_feature_state(image, state))
+            cv2.waitKey(1)
+
+        cv2.destroyWindow(self._window_name)
+
+    def release(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        self._thread.join()
@@ -1,18 +1,26 @@
 
 
+import inspect
 import math
 import cv2
 import dlib
 import numpy as np
 import time
-import mtcnn
 
-def weighted_average(previous_state, current_state, alpha):
+from .CaptureThread import CaptureThread
+from .FrameSources import CameraSource
+from .LatencyStats import LatencyStats
+from .Tracing import tracer
+
+def ema_update(state, detected, alpha):
     """
-    Computes an elementwise weighted average between two arrays
+    Moves a state array toward a detected value in place with an exponential moving average
     """
 
-    return [int(x[0] * (1 - alpha) + x[1] * alpha) for x in zip(previous_state, current_state)]
+    state *= 1 - alpha
+    state += np.multiply(detected, alpha)
+
+    return state
 
 def get_largest_box(boxes):
     """
@@ -35,7 +43,9 @@ def box_to_rect(box):
     Converts box in (x,y,w,h) format into dlib rectangle object
     """
 
-    return dlib.rectangle(box[0], box[1], box[0]+box[2], box[1]+box[3])
+    x, y, w, h = [int(i) for i in box]
+
+    return dlib.rectangle(x, y, x+w, y+h)
 
 def rect_to_box(rect):
     """
@@ -44,24 +54,19 @@ def rect_to_box(rect):
 
     return (rect.left(), rect.top(), rect.width(), rect.height())
 
-def convert_shape_to_list(shape):
+def convert_shape_to_array(shape, out=None):
     """
-    Converts dlib shape object to list
+    Writes the points of a dlib shape object into a (68, 2) array
     """
 
-    lst = []
-    for i in range(0, 68):
-        lst.append(shape.part(i).x)
-        lst.append(shape.part(i).y)
-    
-    return lst
+    if out is None:
+        out = np.empty((68, 2), dtype=np.double)
 
-def get_point_from_shapelist(shapelist, index):
-    """
-    Given a list created from a pose shape and point number, return an (x,y) tuple
-    """
+    for i, point in enumerate(shape.parts()):
+        out[i, 0] = point.x
+        out[i, 1] = point.y
 
-    return (shapelist[index * 2], shapelist[index * 2 + 1])
+    return out
 
 def get_x_gradient(image):
     output = np.zeros(image.shape, dtype=np.double)
@@ -75,8 +80,8 @@ def get_x_gradient(image):
 
 def get_image_gradients(image):
 
-    sobel_x = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=3).astype('float64')
-    sobel_y = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=3).astype('float64')
+    sobel_x = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=3)
+    sobel_y = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=3)
 
     #sobel_x = get_x_gradient(image)
     #sobel_y = np.transpose(get_x_gradient(np.transpose(image)))
@@ -84,12 +89,7 @@ def get_image_gradients(image):
     return sobel_x, sobel_y
 
 def get_magnitudes(x_gradients, y_gradients):
-    mags = np.zeros(x_gradients.shape, dtype=np.double)
-    for y in range(0, len(mags)):
-        for x in range(0, len(mags[y])):
-            mags[y][x] = math.sqrt((x_gradients[y][x] * x_gradients[y][x]) + (y_gradients[y][x] * y_gradients[y][x]))
-    
-    return mags
+    return cv2.magnitude(x_gradients, y_gradients)
 
 def compute_threshold(image, std_dev_factor):
     mean = np.mean(image)
@@ -98,24 +98,66 @@ def compute_threshold(image, std_dev_factor):
     return std_dev_factor * std_dev + mean
 
 def normalize_gradients(x_gradients, y_gradients, magnitudes, threshold):
-    for y in range(0, len(x_gradients)):
-        for x in range(0, len(x_gradients[y])):
-            if magnitudes[y][x] > threshold:
-                #print(x_gradients[y][x])
-                x_gradients[y][x] /= magnitudes[y][x] * 1.0
-                #print(x_gradients[y][x])
-                y_gradients[y][x] /= magnitudes[y][x] * 1.0
-            else:
-                x_gradients[y][x] = 0
-                y_gradients[y][x] = 0
+    mask = magnitudes > threshold
+
+    np.divide(x_gradients, magnitudes, out=x_gradients, where=mask)
+    np.divide(y_gradients, magnitudes, out=y_gradients, where=mask)
+    x_gradients[~mask] = 0
+    y_gradients[~mask] = 0
 
 def blur_and_invert(image):
     blurred = cv2.GaussianBlur(image, (5, 5), 0)
-    for y in range(0, len(blurred)):
-        for x in range(0, len(blurred[y])):
-            blurred[y][x] = 255 - blurred[y][x]
     
-    return blurred
+    return cv2.bitwise_not(blurred, dst=blurred)
+
+class GradientPreprocessor():
+    """
+    Computes the culled unit gradients and inverted weights used by the center-of-gradients objective in a few
+    vectorized passes, writing into buffers that are reused on later frames. Only the buffers for the last image
+    size are kept, so crops whose size changes every frame cost an allocation each instead of growing memory
+    """
+
+    def __init__(self, std_dev_factor=2):
+        self.std_dev_factor = std_dev_factor
+        self._shape = None
+        self._buffers = None
+
+    def _get_buffers(self, shape):
+        if shape != self._shape:
+            self._shape = shape
+            self._buffers = (np.empty(shape, dtype=np.double),  # x gradients
+                             np.empty(shape, dtype=np.double),  # y gradients
+                             np.empty(shape, dtype=np.double),  # magnitudes
+                             np.empty(shape, dtype=bool),       # culling mask
+                             np.empty(shape, dtype=np.uint8))   # inverted weights
+
+        return self._buffers
+
+    def process(self, gray):
+        """
+        Returns (x_gradients, y_gradients, weights) for a grayscale image. The arrays are owned by the preprocessor and
+        the next call may overwrite them whatever its image size, so callers that keep them across calls must copy them
+        """
+
+        x_gradients, y_gradients, magnitudes, mask, weights = self._get_buffers(gray.shape[:2])
+
+        cv2.Sobel(gray, cv2.CV_64F, 1, 0, dst=x_gradients, ksize=3)
+        cv2.Sobel(gray, cv2.CV_64F, 0, 1, dst=y_gradients, ksize=3)
+        cv2.magnitude(x_gradients, y_gradients, magnitude=magnitudes)
+
+        mean, std_dev = cv2.meanStdDev(magnitudes)
+        np.greater(magnitudes, self.std_dev_factor * std_dev[0, 0] + mean[0, 0], out=mask)
+
+        # Divide where the gradient survives the threshold, then zero everything else
+        np.divide(x_gradients, magnitudes, out=x_gradients, where=mask)
+        np.divide(y_gradients, magnitudes, out=y_gradients, where=mask)
+        np.multiply(x_gradients, mask, out=x_gradients)
+        np.multiply(y_gradients, mask, out=y_gradients)
+
+        cv2.GaussianBlur(gray, (5, 5), 0, dst=weights)
+        cv2.bitwise_not(weights, dst=weights)
+
+        return x_gradients, y_gradients, weights
 
 def test_center(x, y, weights, gx, gy, output):
     for cy in range(0, len(output)):
@@ -135,7 +177,11 @@ def test_center(x, y, weights, gx, gy, output):
 
             output[cy][cx] += dot * dot * (weights[y][x] / 0.1)
 
-def test_all_centers(image, weights, x_gradients, y_gradients):
+def test_all_centers_reference(image, weights, x_gradients, y_gradients):
+    """
+    Pure Python version of test_all_centers, kept as the reference the vectorized version is checked against
+    """
+
     output = np.zeros(image.shape, dtype=np.double)
     for y in range(0, len(image)):
         for x in range(0, len(image[y])):
@@ -146,142 +192,403 @@ def test_all_centers(image, weights, x_gradients, y_gradients):
     
     return output
 
+def score_centers(weights, x_gradients, y_gradients, center_xs, center_ys, block_size=256):
+    """
+    Evaluates the center-of-gradients objective for each candidate center given as (center_xs, center_ys) arrays.
+    Gradient pixels are processed in blocks so memory stays bounded at block_size * len(center_xs)
+    """
+
+    center_xs = np.asarray(center_xs, dtype=np.double).ravel()
+    center_ys = np.asarray(center_ys, dtype=np.double).ravel()
+    output = np.zeros(center_xs.shape, dtype=np.double)
+
+    ys, xs = np.nonzero((x_gradients != 0) | (y_gradients != 0))
+
+    for start in range(0, len(xs), block_size):
+        block_xs = xs[start:start+block_size]
+        block_ys = ys[start:start+block_size]
+
+        gx = x_gradients[block_ys, block_xs][:, None]
+        gy = y_gradients[block_ys, block_xs][:, None]
+        w = weights[block_ys, block_xs] / 0.1
+
+        dx = block_xs[:, None] - center_xs
+        dy = block_ys[:, None] - center_ys
+
+        squared_magnitude = dx * dx
+        squared_magnitude += dy * dy
+        squared_magnitude[squared_magnitude == 0] = np.inf  # A gradient pixel never votes for itself
+
+        # max(0, d.g / |d|)^2 computed in place as max(0, d.g)^2 / |d|^2
+        dx *= gx
+        dy *= gy
+        dx += dy
+        np.maximum(dx, 0, out=dx)
+        dx *= dx
+        dx /= squared_magnitude
+
+        output += w.dot(dx)
+
+    return output
+
+def test_all_centers(image, weights, x_gradients, y_gradients):
+    """
+    Returns a matrix with the center-of-gradients objective evaluated at every pixel of the image
+    """
+
+    height, width = image.shape[:2]
+    center_ys, center_xs = np.indices((height, width))
+
+    return score_centers(weights, x_gradients, y_gradients, center_xs, center_ys).reshape(height, width)
+
+_displacement_kernel_cache = {}
+
+def get_displacement_kernels(height, width):
+    """
+    Returns the kernels used by test_all_centers_fft for an image of the given size, building and caching them on first use.
+    Each kernel is indexed by the displacement from a candidate center to a gradient pixel
+    """
+
+    key = (height, width)
+
+    if key not in _displacement_kernel_cache:
+        dy, dx = np.mgrid[-(height - 1):height, -(width - 1):width].astype(np.double)
+        magnitude = np.hypot(dx, dy)
+        magnitude[height - 1, width - 1] = np.inf   # Zero displacement contributes nothing
+
+        unit_x = dx / magnitude
+        unit_y = dy / magnitude
+
+        _displacement_kernel_cache[key] = (unit_x, unit_y, unit_x * unit_x, unit_x * unit_y, unit_y * unit_y)
+
+    return _displacement_kernel_cache[key]
+
+def test_all_centers_fft(image, weights, x_gradients, y_gradients, batch_size=32):
+    """
+    Returns a matrix with its maximum at the same pixel and with the same value as test_all_centers, for a fraction of the cost.
+    The clamped objective max(0, cos)^2 is not separable, but two upper bounds of it are: the squared dot cos^2, and ((1 + cos) / 2)^2.
+    Both are sums of correlations against kernels that only depend on the displacement (dx/|d|, dy/|d|, dx^2/|d|^2, dx*dy/|d|^2,
+    dy^2/|d|^2 times the weights), which OpenCV evaluates with the DFT. The exact objective is then scored with score_centers in
+    decreasing order of the bound until no remaining bound can beat the best exact score. Every other entry holds its bound
+    """
+
+    height, width = image.shape[:2]
+    unit_x, unit_y, unit_xx, unit_xy, unit_yy = get_displacement_kernels(height, width)
+
+    mask = (x_gradients != 0) | (y_gradients != 0)
+
+    if not mask.any():
+        return np.zeros((height, width), dtype=np.double)   # Nothing votes, every center scores 0
+
+    w = weights.astype(np.double) / 0.1
+    w *= mask
+    wx = w * x_gradients
+    wy = w * y_gradients
+
+    def correlate(source, kernel):
+        return cv2.filter2D(source, cv2.CV_64F, kernel, anchor=(width - 1, height - 1), borderType=cv2.BORDER_CONSTANT)
+
+    total = w.sum() - w     # A gradient pixel never votes for itself
+    linear = correlate(wx, unit_x) + correlate(wy, unit_y)
+    squared = correlate(wx * x_gradients, unit_xx) + 2 * correlate(wx * y_gradients, unit_xy) + correlate(wy * y_gradients, unit_yy)
+
+    scores = np.minimum(squared, 0.25 * total + 0.5 * linear + 0.25 * squared).ravel()
+    tolerance = 1e-9 * max(float(np.abs(scores).max()), 1.0)     # Round-off of the DFT correlations
+
+    order = np.argsort(scores)[::-1]
+    best = -np.inf
+
+    for start in range(0, len(order), batch_size):
+        candidates = order[start:start+batch_size]
+
+        if scores[candidates[0]] + tolerance < best:
+            break   # No bound that is left can reach the best exact score
+
+        exact = score_centers(weights, x_gradients, y_gradients, candidates % width, candidates // width)
+        scores[candidates] = exact
+        best = max(best, exact.max())
+
+    return scores.reshape(height, width)
+
+def parabolic_offset(left, center, right):
+    """
+    Returns the offset in [-0.5, 0.5] of the vertex of the parabola through three equally spaced samples
+    """
+
+    denominator = left - 2 * center + right
+
+    if denominator >= 0:
+        return 0.0
+
+    return min(max(0.5 * (left - right) / denominator, -0.5), 0.5)
+
+def get_pyramid_sizes(base_scale, full_size, levels=None):
+    """
+    Returns the square sizes searched by the pupil pyramid, doubling from base_scale up to full_size. With levels set
+    there are at most that many, otherwise the last size is always full_size
+    """
+
+    sizes = [min(base_scale, full_size)]
+
+    while (levels is None or len(sizes) < levels) and sizes[-1] < full_size:
+        sizes.append(min(sizes[-1] * 2, full_size))
+
+    return sizes
+
 def scale_image(image, width):
     return cv2.resize(image, (width, width), interpolation=cv2.INTER_AREA)
 
 def unscale_point(point, factor):
     pass
 
-class FeatureExtraction():
-    def __init__(self, face_cascade_path, eye_cascade_path, shape_predictor_path):
-        
-        self.cap = cv2.VideoCapture(0)
-        _, self.capture = self.cap.read()
+def clip_box(box, shape):
+    """
+    Clips an (x,y,w,h) box to an image of the given shape, returning integer coordinates
+    """
 
-        self.face_cascade = cv2.CascadeClassifier(face_cascade_path)
-        self.eye_cascade = cv2.CascadeClassifier(eye_cascade_path)
+    x, y, w, h = [int(i) for i in box]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + w, shape[1]), min(y + h, shape[0])
 
-        self.pose_predictor = dlib.shape_predictor(shape_predictor_path)
-        self.mtcnn_detector = mtcnn.MTCNN()
-        self.hog_detector = dlib.get_frontal_face_detector()
+    return (x1, y1, max(x2 - x1, 0), max(y2 - y1, 0))
+
+def expand_box(box, margin):
+    """
+    Grows an (x,y,w,h) box on every side by margin times its width or height
+    """
+
+    x, y, w, h = box
+
+    return (x - w * margin, y - h * margin, w * (1 + 2 * margin), h * (1 + 2 * margin))
+
+def crop_view(image, box):
+    """
+    Returns the part of an image covered by an (x,y,w,h) box as a view, clipped to the image bounds
+    """
+
+    x, y, w, h = clip_box(box, image.shape)
+
+    return image[y:y+h, x:x+w]
+
+class Frame():
+    """
+    A captured BGR image along with the conversions the detectors share. Each conversion is computed on first use
+    and cached, so it happens at most once per frame. The timestamp is time.perf_counter() at capture
+    """
+
+    def __init__(self, image, timestamp=0, sequence=0):
+        self.image = image
+        self.timestamp = timestamp
+        self.sequence = sequence
+
+        self._gray = None
+        self._rgb = None
+        self._downscaled = {}
+
+    def get_gray(self):
+        if self._gray is None:
+            self._gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
 
-        self.current_state = {
-            "face": (0, 0, 100, 100),
-            "right_eye": (0, 0, 10, 10),
-            "left_eye": (0, 0, 10, 10),
-            "right_pupil": (0, 0),
-            "left_pupil": (0, 0),
-            "pose": [0 for i in range(0, 68 * 2)]
-        }
+        return self._gray
 
-        cv2.startWindowThread()
+    def get_rgb(self):
+        if self._rgb is None:
+            self._rgb = cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
+
+        return self._rgb
+
+    def get_downscaled(self, factor):
+        """
+        Returns the grayscale image shrunk by the given factor
+        """
+
+        if factor == 1:
+            return self.get_gray()
+
+        if factor not in self._downscaled:
+            gray = self.get_gray()
+            size = (max(1, int(gray.shape[1] / factor)), max(1, int(gray.shape[0] / factor)))
+            self._downscaled[factor] = cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+        return self._downscaled[factor]
+
+# Layout of FeatureExtraction.current_state. Boxes are (x,y,w,h); eyes, pupils and pose points are relative to the face box
+FEATURE_STATE_DTYPE = np.dtype([("face", np.double, 4),
+                                ("right_eye", np.double, 4),
+                                ("left_eye", np.double, 4),
+                                ("right_pupil", np.double, 2),
+                                ("left_pupil", np.double, 2),
+                                ("pose", np.double, (68, 2))])
+
+def create_feature_state():
+    """
+    Returns a zeroed feature state with the default face and eye boxes
+    """
 
-    def _detect_face_haar(self, image, scale_factor=1.05, min_neighbors=6):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray, scale_factor, min_neighbors)
+    state = np.zeros((), dtype=FEATURE_STATE_DTYPE)
+    state["face"] = (0, 0, 100, 100)
+    state["right_eye"] = (0, 0, 10, 10)
+    state["left_eye"] = (0, 0, 10, 10)
+
+    return state
+
+def state_to_vector(state, out=None):
+    """
+    Writes [right_pupil_x, right_pupil_y, left_pupil_x, left_pupil_y], relative to the face size, into out
+    """
+
+    if out is None:
+        out = np.empty(4, dtype=np.double)
+
+    face_size = state["face"][2:4]
+
+    np.add(state["right_pupil"], state["right_eye"][0:2], out=out[0:2])
+    np.add(state["left_pupil"], state["left_eye"][0:2], out=out[2:4])
+    np.divide(out[0:2], face_size, out=out[0:2])
+    np.divide(out[2:4], face_size, out=out[2:4])
+
+    return out
+
+def draw_feature_state(img, state):
+    """
+    Draws the face box, eye boxes, pupils and pose points of a feature state onto an image in place
+    """
+
+    face = state["face"].astype(int)
+    cv2.rectangle(img, (face[0], face[1]), (face[0]+face[2], face[1]+face[3]), (255, 0, 0), 2)
     
-        return get_largest_box(faces)
+    right_eye = state["right_eye"].astype(int)
+    left_eye = state["left_eye"].astype(int)
+    cv2.rectangle(img, (right_eye[0]+face[0], right_eye[1]+face[1]), (right_eye[0]+right_eye[2]+face[0], right_eye[1]+right_eye[3]+face[1]), (0, 255, 0), 2)
+    cv2.rectangle(img, (left_eye[0]+face[0], left_eye[1]+face[1]), (left_eye[0]+left_eye[2]+face[0], left_eye[1]+left_eye[3]+face[1]), (0, 255, 0), 2)
+    
+    left_tuple = tuple(int(i) for i in left_eye[0:2] + face[0:2] + state["left_pupil"])
+    right_tuple = tuple(int(i) for i in right_eye[0:2] + face[0:2] + state["right_pupil"])
 
-    def _detect_face_hog(self, image):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        rects = self.hog_detector(gray, 0)
-        faces = [rect_to_box(rect) for rect in rects]
+    cv2.circle(img, left_tuple, 5, (0, 0, 255), 2)
+    cv2.circle(img, right_tuple, 5, (0, 0, 255), 2)
 
-        return get_largest_box(faces)
+    for x, y in (state["pose"] + face[0:2]).astype(int):
+        cv2.circle(img, (int(x), int(y)), 1, (0, 0, 255), -1)
+
+    return img
 
-    def _detect_face_mtcnn(self, image):
-        rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        faces = [i['box'] for i in self.mtcnn_detector.detect_faces(rgb)]
+class HeadDetector():
+    """
+    Finds the face box, the 68 pose landmarks and the eye boxes in a frame, with HOG on the frame shrunk by face_detection_scale,
+    dlib's shape predictor, and eye boxes placed from the eye corner landmarks. It loads only what that takes, so a process that
+    runs just this stage does not pay for the other detectors
+    """
+
+    def __init__(self, shape_predictor_path, face_detection_scale=1, face_tracking=False, face_roi_margin=0.5, face_redetect_interval=30,
+                 landmark_tracking=False, landmark_redetect_interval=10, landmark_fb_threshold=1.0, tracked_pose_alpha=1, latency_stats=None):
+
+        self.pose_predictor = dlib.shape_predictor(shape_predictor_path)
+        self.hog_detector = dlib.get_frontal_face_detector()
+        self.face_detection_scale = face_detection_scale    # HOG runs on the frame shrunk by this factor
+
+        # When tracking, HOG only searches the last face box grown by face_roi_margin on each side,
+        # falling back to the full frame every face_redetect_interval frames or when the ROI search fails
+        self.face_tracking = face_tracking
+        self.face_roi_margin = face_roi_margin
+        self.face_redetect_interval = face_redetect_interval
+        self._frames_since_full_detection = face_redetect_interval
+
+        # When tracking, landmarks follow Lucas-Kanade optical flow between frames and the shape predictor only reruns every
+        # landmark_redetect_interval frames or when a point's forward-backward error exceeds landmark_fb_threshold pixels
+        self.landmark_tracking = landmark_tracking
+        self.landmark_redetect_interval = landmark_redetect_interval
+        self.landmark_fb_threshold = landmark_fb_threshold
+        self.tracked_pose_alpha = tracked_pose_alpha
+        self._landmark_gray = None
+        self._landmark_points = None
+        self._frames_since_landmark_detection = landmark_redetect_interval
+
+        self._detected_pose = np.empty((68, 2), dtype=np.double)
+        self.latency_stats = latency_stats if latency_stats is not None else LatencyStats()
+
+    def _detect_face_hog(self, frame):
+        gray = frame.get_downscaled(self.face_detection_scale)
+        rects = self.hog_detector(gray, 0)
+        faces = [tuple(int(i * self.face_detection_scale) for i in rect_to_box(rect)) for rect in rects]
 
         return get_largest_box(faces)
 
-    def _detect_eye_haar(self, image, scale_factor=1.05, min_neighbors=6):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        eyes = self.eye_cascade.detectMultiScale(gray, scale_factor, min_neighbors)
+    def _detect_face_hog_roi(self, frame, box):
+        """
+        Runs HOG only inside the given box expanded by face_roi_margin, returning the face in frame coordinates.
+        Like the full frame search it works on the frame shrunk by face_detection_scale
+        """
 
-        return get_largest_box(eyes)
+        scale = self.face_detection_scale
+        gray = frame.get_downscaled(scale)
+        roi_x, roi_y, roi_w, roi_h = clip_box([i / scale for i in expand_box(box, self.face_roi_margin)], gray.shape)
 
-    def _detect_pose(self, image):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        rect = box_to_rect(self.current_state["face"])
+        if roi_w == 0 or roi_h == 0:
+            return []
 
-        return convert_shape_to_list(self.pose_predictor(gray, rect))
+        rects = self.hog_detector(np.ascontiguousarray(gray[roi_y:roi_y+roi_h, roi_x:roi_x+roi_w]), 0)
+        faces = [tuple(int(i * scale) for i in (x + roi_x, y + roi_y, w, h)) for (x, y, w, h) in [rect_to_box(rect) for rect in rects]]
 
-    def _detect_pupil(self, image):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (5, 5), 0)
-        _, _, min_loc, _ = cv2.minMaxLoc(gray)
+        return get_largest_box(faces)
 
-        return min_loc
-    
-    def _detect_pupil_dot(self, image, image_scale=20):
-        
-        width_scale = image.shape[1] / image_scale
-        height_scale = image.shape[1] / image_scale
+    def _detect_pose(self, frame, box):
+        rect = box_to_rect(box)
 
-        downscaled = scale_image(image, image_scale)
+        return convert_shape_to_array(self.pose_predictor(frame.get_gray(), rect), self._detected_pose)
 
-        gray = cv2.cvtColor(downscaled, cv2.COLOR_BGR2GRAY)
+    def _track_pose(self, frame, window_size=(21, 21), max_level=3):
+        """
+        Follows the landmarks of the previous frame into this one with pyramidal Lucas-Kanade optical flow.
+        Returns the tracked points, or None when any point is lost or fails the forward-backward check
+        """
 
-        x_gradients, y_gradients = get_image_gradients(gray)    # Compute gradients in each direction as well as magnitude
-        magnitudes = get_magnitudes(x_gradients, y_gradients)
+        if self._landmark_points is None:
+            return None
 
-        threshold = compute_threshold(magnitudes, 2)   # compute the threshold for culling the gradients
+        gray = frame.get_gray()
+        lk_params = dict(winSize=window_size, maxLevel=max_level)
 
-        normalize_gradients(x_gradients, y_gradients, magnitudes, threshold)    # Normalize and cull gradients
+        points, status, _ = cv2.calcOpticalFlowPyrLK(self._landmark_gray, gray, self._landmark_points, None, **lk_params)
+        if points is None or not status.all():
+            return None
 
-        weights = blur_and_invert(gray) # Find weights by blurring and inverting the image
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self._landmark_gray, points, None, **lk_params)
+        if back_points is None or not back_status.all():
+            return None
 
-        possible = test_all_centers(gray, weights, x_gradients, y_gradients)    # get a matrix of possible centers
-        
-        _, _, _, max_loc = cv2.minMaxLoc(possible)  # Find the max of that centers matrix as the eye center
+        fb_error = np.linalg.norm(back_points - self._landmark_points, axis=2)
+        if fb_error.max() > self.landmark_fb_threshold:
+            return None
 
-        return (int(max_loc[0] * width_scale), int(max_loc[1] * height_scale))
+        return points
 
-    def _capture_image(self):
-        ret, self.capture = self.cap.read()
-        
-        if not ret:
-            return -1
-        else:
-            return 1
+    def _update_face_state(self, frame, state, alpha):
+        face = []
 
-    def _update_face_state(self, alpha):
-        face = self._detect_face_hog(self.capture)
+        if self.face_tracking and self._frames_since_full_detection < self.face_redetect_interval:
+            face = self._detect_face_hog_roi(frame, state["face"])
+            self._frames_since_full_detection += 1
+
+        if len(face) == 0:
+            face = self._detect_face_hog(frame)
+            self._frames_since_full_detection = 0 if len(face) > 0 else self.face_redetect_interval
 
         if len(face) == 0:
             return -1
         
-        self.current_state["face"] = weighted_average(self.current_state["face"], face, alpha)
+        ema_update(state["face"], face, alpha)
 
         return 1
 
-    def _update_eye_state(self, alpha):
-        face_x, face_y, face_w, face_h = self.current_state["face"]
-        
-        half_face_w = int(face_w / 2)
-        half_face_h = int(face_h / 2)
-        
-        left_eye = self._detect_eye_haar(self.capture[face_y:face_y+half_face_h, face_x:face_x+half_face_w])
-        right_eye = self._detect_eye_haar(self.capture[face_y:face_y+half_face_h, face_x+half_face_w:face_x+face_w])
-
-        if len(left_eye) > 0:
-            self.current_state["left_eye"] = weighted_average(self.current_state["left_eye"], (left_eye[0] + face_x, left_eye[1] + face_y, left_eye[2], left_eye[3]), alpha)
+    def _update_eye_state_from_pose(self, state, alpha):
+        pose = state["pose"]
 
-        if len(right_eye) > 0:
-            self.current_state["right_eye"] = weighted_average(self.current_state["right_eye"], (right_eye[0] + face_x + half_face_w, right_eye[1] + face_y, right_eye[2], right_eye[3]), alpha)
-        
-        return 1
-    
-    def _update_eye_state_from_pose(self, alpha):
-        if len(self.current_state['pose']) == 0:
-            return -1
-        
-        left_outer_point = get_point_from_shapelist(self.current_state['pose'], 36)
-        left_inner_point = get_point_from_shapelist(self.current_state['pose'], 39)
+        left_outer_point = pose[36]
+        left_inner_point = pose[39]
 
-        right_outer_point = get_point_from_shapelist(self.current_state['pose'], 45)
-        right_inner_point = get_point_from_shapelist(self.current_state['pose'], 42)
+        right_outer_point = pose[45]
+        right_inner_point = pose[42]
 
         left_width = left_inner_point[0] - left_outer_point[0]
         right_width = right_outer_point[0] - right_inner_point[0]
@@ -294,102 +601,391 @@ class FeatureExtraction():
         left_eye = (left_x, left_y, left_width, left_width)
         right_eye = (right_x, right_y, right_width, right_width)
 
-        self.current_state["left_eye"] = weighted_average(self.current_state["left_eye"], left_eye, alpha)
-        self.current_state["right_eye"] = weighted_average(self.current_state["right_eye"], right_eye, alpha)
+        ema_update(state["left_eye"], left_eye, alpha)
+        ema_update(state["right_eye"], right_eye, alpha)
 
         return 1
-    
-    def _update_pose_state(self, alpha):
-        detected_pose = self._detect_pose(self.capture)
 
-        for i in [x for x in range(68 * 2) if x % 2 == 0]:
-            detected_pose[i] -= self.current_state["face"][0]
-            detected_pose[i + 1] -= self.current_state["face"][1]
+    def _update_pose_state(self, frame, state, alpha):
+        tracked = None
+
+        if self.landmark_tracking and self._frames_since_landmark_detection < self.landmark_redetect_interval:
+            tracked = self._track_pose(frame)
+
+        if tracked is None:
+            detected_pose = self._detect_pose(frame, state["face"])
+            points = detected_pose.astype(np.float32).reshape(-1, 1, 2)
+            self._frames_since_landmark_detection = 0
+        else:
+            detected_pose = self._detected_pose
+            detected_pose[:] = tracked.reshape(-1, 2)
+            points = tracked
+            alpha = self.tracked_pose_alpha   # Flow is already temporally consistent, so it needs little smoothing
+            self._frames_since_landmark_detection += 1
+
+        if self.landmark_tracking:
+            self._landmark_gray = frame.get_gray()
+            self._landmark_points = points
+
+        detected_pose -= state["face"][0:2]   # Pose is stored relative to the face box
         
-        self.current_state["pose"] = weighted_average(self.current_state["pose"], detected_pose, alpha)
-        #self.current_state["pose"] = self._detect_pose(self.capture)
+        ema_update(state["pose"], detected_pose, alpha)
 
         return 1
 
-    def _update_pupil_state(self, alpha):
-        left_eye_x, left_eye_y, left_eye_w, left_eye_h = self.current_state["left_eye"]
-        right_eye_x, right_eye_y, right_eye_w, right_eye_h = self.current_state["right_eye"]
-        face_x, face_y, _, _ = self.current_state["face"]
+    def update(self, frame, state, face_alpha=0.15, eye_alpha=1, pose_alpha=0.7):
+        """
+        Updates the face box, pose and eye boxes of a feature state in place from a frame
+        """
+
+        with self.latency_stats.span("face"):
+            self._update_face_state(frame, state, face_alpha)
+
+        with self.latency_stats.span("pose"):
+            self._update_pose_state(frame, state, pose_alpha)
+
+        with self.latency_stats.span("eye_boxes"):
+            self._update_eye_state_from_pose(state, eye_alpha)
+
+class PupilDetector():
+    """
+    Finds the pupils inside the eye boxes of a feature state with the center-of-gradients objective. It needs no models,
+    only scratch buffers for the gradients
+    """
+
+    def __init__(self, pupil_backend="direct", pupil_image_scale=20, pupil_search="fixed", latency_stats=None):
+
+        # "direct" evaluates the objective at every pixel, "fft" bounds it with correlations and only evaluates it near the peak,
+        # which scales to full resolution eye crops
+        self.pupil_backend = pupil_backend
+        self.pupil_image_scale = pupil_image_scale
+
+        # "fixed" searches one downscaled crop, "pyramid" refines coarse-to-fine to a sub-pixel estimate
+        self.pupil_search = pupil_search
+        self.gradient_preprocessor = GradientPreprocessor()
+
+        self.latency_stats = latency_stats if latency_stats is not None else LatencyStats()
+
+    def _detect_pupil_dot(self, image, image_scale=20):
+        """
+        Finds the pupil center in a grayscale eye crop with the center-of-gradients objective.
+        An image_scale of None searches the crop at its native resolution
+        """
+
+        if image_scale is None:
+            width_scale = 1
+            height_scale = 1
+
+            gray = image
+        else:
+            width_scale = image.shape[1] / image_scale
+            height_scale = image.shape[1] / image_scale
+
+            gray = scale_image(image, image_scale)
+
+        x_gradients, y_gradients, weights = self.gradient_preprocessor.process(gray)
+
+        possible = self._score_all_centers(gray, weights, x_gradients, y_gradients)     # get a matrix of possible centers
+        
+        _, _, _, max_loc = cv2.minMaxLoc(possible)  # Find the max of that centers matrix as the eye center
+
+        return (int(max_loc[0] * width_scale), int(max_loc[1] * height_scale))
+
+    def _score_all_centers(self, gray, weights, x_gradients, y_gradients):
+        """
+        Returns the objective at every pixel of gray (exact at its maximum) with the configured pupil_backend
+        """
+
+        if self.pupil_backend == "fft":
+            return test_all_centers_fft(gray, weights, x_gradients, y_gradients)
+
+        return test_all_centers(gray, weights, x_gradients, y_gradients)
+
+    def _detect_pupil_pyramid(self, image, base_scale=20, levels=None, window=2):
+        """
+        Finds the pupil center in a grayscale eye crop coarse-to-fine. The whole crop is searched at base_scale with the configured
+        pupil_backend, each finer level only searches a window around the previous estimate, and a parabolic fit around the final
+        peak gives a sub-pixel location. By default levels double in size until the native crop size, levels caps their number
+        """
+
+        gray = image
+        full_size = max(1, min(gray.shape[:2]))
+
+        if base_scale is None:
+            base_scale = full_size
+
+        best_x, best_y, size = None, None, None
+
+        for level_size in get_pyramid_sizes(base_scale, full_size, levels):
+            level = scale_image(gray, level_size)
+            x_gradients, y_gradients, weights = self.gradient_preprocessor.process(level)
+
+            if best_x is None:
+                _, _, _, (best_x, best_y) = cv2.minMaxLoc(self._score_all_centers(level, weights, x_gradients, y_gradients))
+                size = level_size
+                continue
+
+            # Map the previous estimate onto this level, treating coordinates as pixel centers
+            factor = level_size / size
+            guess_x = int(round((best_x + 0.5) * factor - 0.5))
+            guess_y = int(round((best_y + 0.5) * factor - 0.5))
+
+            center_ys, center_xs = np.mgrid[max(guess_y - window, 0):min(guess_y + window + 1, level_size),
+                                            max(guess_x - window, 0):min(guess_x + window + 1, level_size)]
+
+            scores = score_centers(weights, x_gradients, y_gradients, center_xs, center_ys)
+            best = np.argmax(scores)
+            best_x, best_y, size = int(center_xs.ravel()[best]), int(center_ys.ravel()[best]), level_size
+
+        # Sample the objective at the four neighbours of the peak for the sub-pixel fit
+        neighbour_xs = np.clip([best_x - 1, best_x + 1, best_x, best_x], 0, size - 1)
+        neighbour_ys = np.clip([best_y, best_y, best_y - 1, best_y + 1], 0, size - 1)
+        center_score = score_centers(weights, x_gradients, y_gradients, [best_x], [best_y])[0]
+        left, right, up, down = score_centers(weights, x_gradients, y_gradients, neighbour_xs, neighbour_ys)
+
+        sub_x = best_x + parabolic_offset(left, center_score, right)
+        sub_y = best_y + parabolic_offset(up, center_score, down)
+
+        return ((sub_x + 0.5) * image.shape[1] / size - 0.5, (sub_y + 0.5) * image.shape[0] / size - 0.5)
+
+    def _update_pupil_state(self, frame, state, alpha):
+        left_eye_x, left_eye_y, left_eye_w, left_eye_h = state["left_eye"]
+        right_eye_x, right_eye_y, right_eye_w, right_eye_h = state["right_eye"]
+        face_x, face_y, _, _ = state["face"]
 
         left_eye_x += face_x
         left_eye_y += face_y
         right_eye_x += face_x
         right_eye_y += face_y
 
-        left_pupil = self._detect_pupil_dot(self.capture[left_eye_y:left_eye_y+left_eye_h, left_eye_x:left_eye_x+left_eye_w])
-        right_pupil = self._detect_pupil_dot(self.capture[right_eye_y:right_eye_y+right_eye_h, right_eye_x:right_eye_x+right_eye_w])
+        gray = frame.get_gray()
+        left_crop = crop_view(gray, (left_eye_x, left_eye_y, left_eye_w, left_eye_h))
+        right_crop = crop_view(gray, (right_eye_x, right_eye_y, right_eye_w, right_eye_h))
+
+        detect_pupil = self._detect_pupil_pyramid if self.pupil_search == "pyramid" else self._detect_pupil_dot
+
+        with self.latency_stats.span("left_pupil"):
+            left_pupil = detect_pupil(left_crop, self.pupil_image_scale)
+
+        with self.latency_stats.span("right_pupil"):
+            right_pupil = detect_pupil(right_crop, self.pupil_image_scale)
 
         #left_tuple = tuple([sum(x) for x in zip((left_eye_x, left_eye_y), left_pupil)])
         #right_tuple = tuple([sum(x) for x in zip((right_eye_x, right_eye_y), right_pupil)])
 
-        self.current_state["left_pupil"] = weighted_average(self.current_state["left_pupil"], left_pupil, alpha)
-        self.current_state["right_pupil"] = weighted_average(self.current_state["right_pupil"], right_pupil, alpha)
+        ema_update(state["left_pupil"], left_pupil, alpha)
+        ema_update(state["right_pupil"], right_pupil, alpha)
 
         return 1
-    
-    def update_feature_state(self, face_alpha=0.15, eye_alpha=1, pupil_alpha=0.3, pose_alpha=0.7):
-        self._capture_image()
+
+    def update(self, frame, state, alpha=0.3):
+        """
+        Updates the pupil positions of a feature state in place from a frame and the state's eye boxes
+        """
+
+        self._update_pupil_state(frame, state, alpha)
+
+def get_detector_options(detector_class, options):
+    """
+    Returns the entries of options, keyword arguments for FeatureExtraction, that the constructor of detector_class takes
+    """
+
+    parameters = inspect.signature(detector_class).parameters
+
+    return {name: value for name, value in options.items() if name in parameters}
+
+class FeatureExtraction():
+    def __init__(self, face_cascade_path, eye_cascade_path, shape_predictor_path, pupil_backend="direct", pupil_image_scale=20, pupil_search="fixed", face_detection_scale=1,
+                 face_tracking=False, face_roi_margin=0.5, face_redetect_interval=30,
+                 landmark_tracking=False, landmark_redetect_interval=10, landmark_fb_threshold=1.0, tracked_pose_alpha=1,
+                 source=None, threaded_capture=None, capture_timeout=0.1, display=True):
         
-        self._update_face_state(face_alpha)
-        self._update_pose_state(pose_alpha)
-        #self._update_eye_state(eye_alpha)
-        self._update_eye_state_from_pose(eye_alpha)
-        self._update_pupil_state(pupil_alpha)
+        # Any frame source works here (see FrameSources), the default is the first camera
+        self.cap = source if source is not None else CameraSource(0)
+
+        # A capture thread keeps grabbing frames so the processing loop always gets the newest one. By default only live
+        # sources use it, replayed sources are read synchronously so every recorded frame gets processed
+        if threaded_capture is None:
+            threaded_capture = self.cap.is_live
+
+        self.capture_thread = CaptureThread(self.cap) if threaded_capture else None
+        self.capture_timeout = capture_timeout  # Longest wait for a new frame, about three frame periods at 30 fps
+        self._capture_sequence = 0
+
+        self.capture = None
+        self.frame = None
+
+        self.face_cascade = cv2.CascadeClassifier(face_cascade_path)
+        self.eye_cascade = cv2.CascadeClassifier(eye_cascade_path)
+        self.mtcnn_detector = None  # Created on first use, it loads TensorFlow
+
+        # Per-stage timings and counters, see get_latency_snapshot()
+        self.latency_stats = LatencyStats()
+
+        # The head and pupil stages, which VisionPipeline also runs on their own in separate processes
+        self.head_detector = HeadDetector(shape_predictor_path, face_detection_scale, face_tracking, face_roi_margin, face_redetect_interval,
+                                          landmark_tracking, landmark_redetect_interval, landmark_fb_threshold, tracked_pose_alpha, self.latency_stats)
+        self.pupil_detector = PupilDetector(pupil_backend, pupil_image_scale, pupil_search, self.latency_stats)
+
+        # All tracked features live in one contiguous structured array, current_state["face"] etc. are views into it
+        self.current_state = create_feature_state()
+        self._state_vector = np.empty(4, dtype=np.double)
+
+        self.display = display  # Without a display HighGUI is never touched, headless OpenCV builds do not implement it
+
+        if display:
+            cv2.startWindowThread()
+
+    def _detect_face_haar(self, frame, scale_factor=1.05, min_neighbors=6):
+        faces = self.face_cascade.detectMultiScale(frame.get_gray(), scale_factor, min_neighbors)
+    
+        return get_largest_box(faces)
+
+    def _detect_face_mtcnn(self, frame):
+        if self.mtcnn_detector is None:
+            import mtcnn
+            self.mtcnn_detector = mtcnn.MTCNN()
+
+        faces = [i['box'] for i in self.mtcnn_detector.detect_faces(frame.get_rgb())]
+
+        return get_largest_box(faces)
+
+    def _detect_eye_haar(self, gray, scale_factor=1.05, min_neighbors=6):
+        eyes = self.eye_cascade.detectMultiScale(gray, scale_factor, min_neighbors)
+
+        return get_largest_box(eyes)
+
+    def _detect_pupil(self, gray):
+        gray = cv2.GaussianBlur(gray, (5, 5), 0)
+        _, _, min_loc, _ = cv2.minMaxLoc(gray)
+
+        return min_loc
+    
+    def _capture_image(self):
+        if self.capture_thread is not None:
+            ret, image, timestamp, sequence = self.capture_thread.read(self.capture_timeout)
+        else:
+            ret, image = self.cap.read()
+            timestamp = time.perf_counter()
+            self._capture_sequence += 1
+            sequence = self._capture_sequence
         
+        if not ret:
+            return -1
+        else:
+            self.capture = image
+            self.frame = Frame(image, timestamp, sequence)
+            return 1
+
+    def get_dropped_frames(self):
+        """
+        Returns how many captured frames were replaced by a newer one before processing got to them
+        """
+
+        if self.capture_thread is None:
+            return 0
 
-    def display_feature_state(self):
-        img = self.capture
+        return self.capture_thread.get_dropped_frames()
 
-        face = self.current_state["face"]
-        cv2.rectangle(img, (face[0], face[1]), (face[0]+face[2], face[1]+face[3]), (255, 0, 0), 2)
+    def _update_eye_state(self, alpha):
+        face_x, face_y, face_w, face_h = self.current_state["face"]
         
-        right_eye = self.current_state["right_eye"]
-        left_eye = self.current_state["left_eye"]
-        cv2.rectangle(img, (right_eye[0]+face[0], right_eye[1]+face[1]), (right_eye[0]+right_eye[2]+face[0], right_eye[1]+right_eye[3]+face[1]), (0, 255, 0), 2)
-        cv2.rectangle(img, (left_eye[0]+face[0], left_eye[1]+face[1]), (left_eye[0]+left_eye[2]+face[0], left_eye[1]+left_eye[3]+face[1]), (0, 255, 0), 2)
+        half_face_w = int(face_w / 2)
+        half_face_h = int(face_h / 2)
         
-        left_tuple = tuple([sum(x) for x in zip((left_eye[0]+face[0], left_eye[1]+face[1]), self.current_state["left_pupil"])])
-        right_tuple = tuple([sum(x) for x in zip((right_eye[0]+face[0], right_eye[1]+face[1]), self.current_state["right_pupil"])])
+        gray = self.frame.get_gray()
+        left_eye = self._detect_eye_haar(crop_view(gray, (face_x, face_y, half_face_w, half_face_h)))
+        right_eye = self._detect_eye_haar(crop_view(gray, (face_x + half_face_w, face_y, face_w - half_face_w, half_face_h)))
 
-        cv2.circle(img, left_tuple, 5, (0, 0, 255), 2)
-        cv2.circle(img, right_tuple, 5, (0, 0, 255), 2)
+        if len(left_eye) > 0:
+            ema_update(self.current_state["left_eye"], (left_eye[0] + face_x, left_eye[1] + face_y, left_eye[2], left_eye[3]), alpha)
 
-        for point in range(0, 68):
-            initial_point = list(get_point_from_shapelist(self.current_state['pose'], point))
-            initial_point[0] += face[0]
-            initial_point[1] += face[1]
-            initial_point = tuple(initial_point)
+        if len(right_eye) > 0:
+            ema_update(self.current_state["right_eye"], (right_eye[0] + face_x + half_face_w, right_eye[1] + face_y, right_eye[2], right_eye[3]), alpha)
+        
+        return 1
+    
+    def set_frame(self, frame):
+        """
+        Makes the given frame the one the update methods work on, for callers that capture frames themselves
+        """
 
-            cv2.circle(img, initial_point, 1, (0, 0, 255), -1)
+        self.frame = frame
+        self.capture = frame.image
 
-        cv2.imshow("img", img)
-    
-    def get_state_as_vector(self):
-        #temp_list = [self.current_state["face"], 
-        #             self.current_state["right_eye"], 
-        #             self.current_state["left_eye"], 
-        #             self.current_state["right_pupil"], 
-        #             self.current_state["left_pupil"]]
-        
-        right_pupil_x = (self.current_state["right_pupil"][0] + self.current_state["right_eye"][0]) / self.current_state["face"][2]
-        right_pupil_y = (self.current_state["right_pupil"][1] + self.current_state["right_eye"][1]) / self.current_state["face"][3]
-        left_pupil_x = (self.current_state["left_pupil"][0] + self.current_state["left_eye"][0]) / self.current_state["face"][2]
-        left_pupil_y = (self.current_state["left_pupil"][1] + self.current_state["left_eye"][1]) / self.current_state["face"][3]
+    def update_head_state(self, face_alpha=0.15, eye_alpha=1, pose_alpha=0.7):
+        """
+        Updates the face box, pose and eye boxes from the current frame
+        """
 
-        #print("right pupil x", right_pupil_x)
-        #print("right pupil y", right_pupil_y)
-        #print("left pupil x", left_pupil_x)
-        #print("left pupil y", left_pupil_y)
+        self.head_detector.update(self.frame, self.current_state, face_alpha, eye_alpha, pose_alpha)
+
+    def update_pupil_state(self, pupil_alpha=0.3):
+        """
+        Updates the pupil positions from the current frame and eye boxes
+        """
+
+        self.pupil_detector.update(self.frame, self.current_state, pupil_alpha)
+
+    def update_feature_state(self, face_alpha=0.15, eye_alpha=1, pupil_alpha=0.3, pose_alpha=0.7):
+        with self.latency_stats.span("capture"):
+            captured = self._capture_image()
 
-        return [right_pupil_x, right_pupil_y, left_pupil_x, left_pupil_y]
+        if captured == -1:
+            self.latency_stats.increment("missed_frames")
+            return -1
+
+        self.latency_stats.increment("frames")
+
+        sequence = self.frame.sequence
+        with tracer.span("features", "frame", {"trace_id": sequence}, ("s", sequence)):
+            self.update_head_state(face_alpha, eye_alpha, pose_alpha)
+            self.update_pupil_state(pupil_alpha)
+
+        return 1
+
+    def is_finished(self):
+        """
+        Returns True once a recorded source has run out of frames
+        """
+
+        return self.cap.finished
+
+    def get_frame_trace(self):
+        """
+        Returns the trace ID (sequence number) and capture time of the frame current_state was last updated from
+        """
+
+        if self.frame is None:
+            return None, None
+
+        return self.frame.sequence, self.frame.timestamp
+
+    def get_latency_snapshot(self):
+        """
+        Returns the per-stage latency percentiles and frame counters, see LatencyStats.snapshot()
+        """
+
+        self.latency_stats.set_counter("dropped_frames", self.get_dropped_frames())
+
+        return self.latency_stats.snapshot()
+
+    def get_state_as_vector(self):
+        """
+        Returns [right_pupil_x, right_pupil_y, left_pupil_x, left_pupil_y] relative to the face size. The array is a buffer
+        owned by the extractor that is rewritten on the next call, so callers that keep it must copy it. Only the thread
+        that updates the state may call it, others should use a copy that thread publishes
+        """
+
+        return state_to_vector(self.current_state, self._state_vector)
     
     def release(self):
-        self.cap.release()
-        for i in range(1,10):
-            cv2.destroyAllWindows()
-            cv2.waitKey(1)
+        if self.capture_thread is not None:
+            self.capture_thread.release()
+        else:
+            self.cap.release()
+
+        if self.display:
+            for i in range(1,10):
+                cv2.destroyAllWindows()
+                cv2.waitKey(1)
@@ -0,0 +1,195 @@
+"""
+Frame Sources
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+class CameraSource():
+    """
+    Live frames from a camera, read through cv2.VideoCapture
+    """
+
+    is_live = True
+
+    def __init__(self, index=0):
+        self.index = index
+        self._cap = cv2.VideoCapture(index)
+        self.finished = False
+
+    def read(self):
+        return self._cap.read()
+
+    def get_size(self):
+        return (int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def get_fingerprint(self):
+        """
+        Returns a string identifying the camera setup, so calibrations made with a different camera are not reused
+        """
+
+        try:
+            backend = self._cap.getBackendName()
+        except cv2.error:
+            backend = "unknown"     # Not available before the camera is opened
+
+        return "camera:{}:{}x{}:{}".format(self.index, *self.get_size(), backend)
+
+    def release(self):
+        self._cap.release()
+
+class ReplaySource():
+    """
+    Base class for recorded sources. Frames are returned as fast as they are asked for, or at their recorded
+    timing when realtime is set. finished becomes True once the recording runs out
+    """
+
+    is_live = False
+
+    def __init__(self, fps=30, realtime=False):
+        self.fps = fps
+        self.realtime = realtime
+        self.finished = False
+
+        self._index = 0
+        self._start_time = None
+
+    def _read_frame(self, index):
+        """
+        Returns the frame at index, or None past the end of the recording
+        """
+
+        raise NotImplementedError
+
+    def _frame_time(self, index):
+        """
+        Returns the recorded time of a frame in seconds from the start of the recording
+        """
+
+        return index / self.fps
+
+    def read(self):
+        image = self._read_frame(self._index)
+
+        if image is None:
+            self.finished = True
+            return False, None
+
+        if self.realtime:
+            if self._start_time is None:
+                self._start_time = time.perf_counter()
+
+            delay = self._start_time + self._frame_time(self._index) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        self._index += 1
+
+        return True, image
+
+    def get_size(self):
+        return (0, 0)
+
+    def get_fingerprint(self):
+        return "{}:{}x{}".format(type(self).__name__, *self.get_size())
+
+    def release(self):
+        pass
+
+class VideoFileSource(ReplaySource):
+    """
+    Frames decoded from a recorded video file
+    """
+
+    def __init__(self, path, realtime=False):
+        self._cap = cv2.VideoCapture(path)
+
+        super().__init__(self._cap.get(cv2.CAP_PROP_FPS) or 30, realtime)
+
+    def _read_frame(self, index):
+        ret, image = self._cap.read()
+
+        return image if ret else None
+
+    def _frame_time(self, index):
+        return self._cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+
+    def get_size(self):
+        return (int(self._cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self._cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    def release(self):
+        self._cap.release()
+
+class ImageDirectorySource(ReplaySource):
+    """
+    Frames loaded from the images in a directory, in sorted file name order
+    """
+
+    def __init__(self, path, fps=30, realtime=False):
+        super().__init__(fps, realtime)
+
+        self._paths = sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+    def _read_frame(self, index):
+        if index >= len(self._paths):
+            return None
+
+        return cv2.imread(self._paths[index])
+
+    def get_size(self):
+        if len(self._paths) == 0:
+            return (0, 0)
+
+        height, width = cv2.imread(self._paths[0]).shape[:2]
+
+        return (width, height)
+
+class RawFrameSource(ReplaySource):
+    """
+    Frames memory-mapped from a dump of uint8 BGR frames. A .npy file carries its own shape,
+    any other file is read as raw bytes and needs the (height, width, channels) of one frame
+    """
+
+    def __init__(self, path, frame_shape=None, fps=30, realtime=False):
+        super().__init__(fps, realtime)
+
+        if path.endswith(".npy"):
+            self._frames = np.load(path, mmap_mode="r")
+        else:
+            if frame_shape is None:
+                raise ValueError("Raw frame dump {} needs frame_shape, the (height, width, channels) of one frame".format(path))
+
+            self._frames = np.memmap(path, dtype=np.uint8, mode="r").reshape((-1,) + tuple(frame_shape))
+
+    def _read_frame(self, index):
+        if index >= len(self._frames):
+            return None
+
+        return np.array(self._frames[index])    # Copy out of the map so detectors can draw on the frame
+
+    def get_size(self):
+        return (self._frames.shape[2], self._frames.shape[1])
+
+def create_frame_source(spec, realtime=False, frame_shape=None, fps=30):
+    """
+    Builds a frame source from a command line style description: a camera index, an image directory,
+    a .npy or .raw frame dump, or a video file
+    """
+
+    spec = str(spec)
+
+    if spec.isdigit():
+        return CameraSource(int(spec))
+    elif os.path.isdir(spec):
+        return ImageDirectorySource(spec, fps=fps, realtime=realtime)
+    elif spec.endswith((".npy", ".raw")):
+        return RawFrameSource(spec, frame_shape=frame_shape, fps=fps, realtime=realtime)
+    else:
+        return VideoFileSource(spec, realtime=realtime)
@@ -0,0 +1,63 @@
+"""
+Gaze Channel
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import collections
+import threading
+
+class GazeChannel():
+    """
+    Hands gaze samples from the tracking thread to consumers. Only the newest sample is kept in a slot tagged with
+    a sequence number, so readers always see the freshest value and memory stays constant. The slot is replaced
+    with a single assignment, so reading it takes no lock. Consumers that want every sample can read the
+    optional bounded history instead
+    """
+
+    def __init__(self, history=0):
+        self._slot = (0, None)  # (sequence, value)
+        self._condition = threading.Condition()
+        self._history = collections.deque(maxlen=history) if history > 0 else None
+
+    def put(self, value):
+        with self._condition:
+            sequence = self._slot[0] + 1
+            self._slot = (sequence, value)
+
+            if self._history is not None:
+                self._history.append(self._slot)
+
+            self._condition.notify_all()
+
+        return sequence
+
+    def get_latest(self):
+        """
+        Returns (sequence, value) for the newest sample, with a sequence of 0 before anything was put
+        """
+
+        return self._slot
+
+    def wait(self, last_sequence, timeout=None):
+        """
+        Waits until a sample newer than last_sequence arrives and returns its (sequence, value), or None on timeout
+        """
+
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._slot[0] > last_sequence, timeout):
+                return None
+
+            return self._slot
+
+    def get_history(self, since_sequence=0):
+        """
+        Returns the (sequence, value) pairs still in the history that are newer than since_sequence
+        """
+
+        if self._history is None:
+            return []
+
+        with self._condition:
+            return [item for item in self._history if item[0] > since_sequence]
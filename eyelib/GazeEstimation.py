@@ -7,12 +7,135 @@ By Dean Lawrence
 
 import numpy as np 
 import copy
-from sklearn.metrics import mean_squared_error
+import logging
+import os
+import time
+from sklearn.base import clone
+from sklearn.linear_model import LinearRegression, Ridge
+
+from .OnlineRegression import RecursiveLeastSquares
+from .SampleStore import SampleStore
+from .PolynomialRegression import get_standardization
+
+# The x estimator reads the even entries of a feature vector and the y estimator the odd ones
+X_COLUMNS = slice(0, None, 2)
+Y_COLUMNS = slice(1, None, 2)
+
+logger = logging.getLogger(__name__)
+
+def compile_linear_model(x_estimator, y_estimator, width, height):
+    """
+    Folds two fitted linear estimators, one reading the even and one the odd entries of the feature vector, and the
+    scaling to screen pixels into a single (coefficients, intercepts) pair, so that coefficients @ features + intercepts
+    is the gaze point in pixels. Returns None when either estimator is not linear (has no coef_ and intercept_)
+    """
+
+    if not all(hasattr(estimator, "coef_") and hasattr(estimator, "intercept_") for estimator in (x_estimator, y_estimator)):
+        return None
+
+    x_coef = np.ravel(x_estimator.coef_)
+    y_coef = np.ravel(y_estimator.coef_)
+
+    coefficients = np.zeros((2, len(x_coef) + len(y_coef)), dtype=np.double)
+    coefficients[0, X_COLUMNS] = x_coef * width
+    coefficients[1, Y_COLUMNS] = y_coef * height
+
+    intercepts = np.array([np.ravel(x_estimator.intercept_)[0] * width, np.ravel(y_estimator.intercept_)[0] * height], dtype=np.double)
+
+    return coefficients, intercepts
+
+def get_ridge_penalty(estimator):
+    """
+    Returns the ridge penalty of an estimator whose fit is (regularized) least squares with an unpenalized
+    intercept, 0 for plain least squares, or None for estimators without a closed form hat matrix
+    """
+
+    if not getattr(estimator, "fit_intercept", True):
+        return None
+
+    if isinstance(estimator, Ridge):
+        return estimator.alpha
+    elif isinstance(estimator, LinearRegression):
+        return 0
+    elif isinstance(estimator, RecursiveLeastSquares) and estimator.forgetting_factor == 1:
+        return 0    # The starting penalty is only there to seed the recursion. With forgetting the fit is weighted, so it has no plain hat matrix
+
+    return None
+
+def cross_validation_residuals(features, labels, alpha=0, folds=None):
+    """
+    Returns the residual of every sample when predicted by a least squares fit (ridge with penalty alpha, with an
+    intercept) to the other samples, computed in closed form from the hat matrix H instead of refitting. For
+    leave-one-out (folds None) a residual is e_i / (1 - H_ii). For k folds, with sample i in fold i % folds,
+    the residuals of fold S are (I - H_SS)^-1 e_S. labels may have a column per output, which all share H.
+    Returns None when some held out fit would be underdetermined
+    """
+
+    features = np.asarray(features, dtype=np.double)
+    labels = np.asarray(labels, dtype=np.double)
+
+    design = np.hstack((features, np.ones((len(features), 1))))
+    penalty = np.full(design.shape[1], alpha, dtype=np.double)
+    penalty[-1] = 0     # The intercept is not penalized
+
+    # H = X G^-1 X' is never formed, only the parts of it that are needed, so the cost is O(n d^2) rather than O(n^2 d)
+    try:
+        projection = np.linalg.solve(design.T @ design + np.diag(penalty), design.T)   # G^-1 X'
+    except np.linalg.LinAlgError:
+        return None
+
+    residuals = labels - design @ (projection @ labels)
+
+    if folds is None:
+        leverage_complement = 1 - np.einsum("ij,ji->i", design, projection)
+
+        if np.any(leverage_complement < 1e-10):
+            return None     # A sample is fit exactly no matter its label, as when there are no more samples than coefficients
+
+        return residuals / leverage_complement.reshape((-1,) + (1,) * (residuals.ndim - 1))
+
+    held_out = np.empty_like(residuals)
+
+    for fold in range(folds):
+        indices = np.arange(fold, len(labels), folds)
+        complement = np.eye(len(indices)) - design[indices] @ projection[:, indices]
+
+        if np.linalg.cond(complement) > 1e10:
+            return None
+
+        held_out[indices] = np.linalg.solve(complement, residuals[indices])
+
+    return held_out
+
+PROFILE_VERSION = 2
+
+def get_profile_path(directory, user):
+    """
+    Returns where the calibration profile of a user is kept
+    """
+
+    return os.path.join(directory, "".join(c if c.isalnum() or c in "-_" else "_" for c in user) + ".npz")
+
+def reset_estimator(estimator):
+    """
+    Returns the estimator with everything it learned forgotten, reset in place when it supports that
+    """
+
+    if hasattr(estimator, "reset"):
+        estimator.reset()
+        return estimator
+
+    return clone(estimator)
 
 class GazeState():
-    def __init__(self, x, y):
+    def __init__(self, x, y, trace_id=None, capture_time=None, fixation_duration=0.0):
         self._x = x
         self._y = y
+
+        self.fixation_duration = fixation_duration  # Seconds the gaze has been fixated at this point, 0 during movement
+
+        self.trace_id = trace_id            # Sequence number of the frame the estimate came from
+        self.capture_time = capture_time    # time.perf_counter() when that frame was captured
     
     def getX(self):
         return self._x
@@ -21,68 +144,155 @@ class GazeState():
         return self._y
 
 class GazeEstimation():
-    def __init__(self, x_estimator, y_estimator, width, height):
+    def __init__(self, x_estimator, y_estimator, width, height, cv_folds=None, joint_model=None):
         
-        self.data = {
-            "x_predictors": [],
-            "x_labels": [],
-            "y_predictors": [],
-            "y_labels": []
-        }
+        self.samples = SampleStore()    # Feature vectors with labels as fractions of the screen size
 
         self.x_estimator = x_estimator
         self.y_estimator = y_estimator
 
+        # A joint model (such as JointPolynomialModel) replaces the two estimators, which may then be None,
+        # and predicts both axes from the whole feature vector
+        self.joint_model = joint_model
+
         self.width = width
         self.height = height
 
+        # test_data() records cross-validated MSE, leave-one-out or with cv_folds folds, when the estimators
+        # are least squares models, and the training MSE otherwise
         self.x_test_errors = []
         self.y_test_errors = []
+        self.cv_folds = cv_folds
+        self._residuals = None
+
+        # Estimators with partial_fit (such as RecursiveLeastSquares) are updated as each sample is added,
+        # so they can predict right away and never need refitting from the whole data set
+        self.online = joint_model is None and hasattr(x_estimator, "partial_fit") and hasattr(y_estimator, "partial_fit")
+
+        # Linear models are compiled to plain arrays after fitting so per-frame prediction skips sklearn entirely.
+        # The pair is replaced in one assignment, so the tracking thread never sees half of an update
+        self._compiled = None
+        self._bounds = np.array([width, height], dtype=np.double)
+        self._prediction = np.empty(2, dtype=np.double)
 
         self._trained = False
 
     def clear_data(self):
-        self.data = {
-            "x_predictors": [],
-            "x_labels": [],
-            "y_predictors": [],
-            "y_labels": []
-        }
+        self.samples.clear()
+        self._residuals = None
 
-        self._trained = False
+        if self.online:
+            self.x_estimator = reset_estimator(self.x_estimator)
+            self.y_estimator = reset_estimator(self.y_estimator)
+
+        self._compiled = None
 
-    def add_sample(self, predictor, label):
+        self._trained = False
 
-        predictor.append(0)
+    def add_sample(self, predictor, label, timestamp=None, frame_id=-1):
+        """
+        Stores a feature vector with the screen point the user was looking at, optionally tagged with the
+        ID of the frame it came from. The timestamp defaults to now
+        """
 
-        x_features = predictor[0:-1:2]
-        y_features = predictor[1:-1:2]
+        self.samples.append(predictor, (label[0] / self.width, label[1] / self.height),
+                            time.time() if timestamp is None else timestamp, frame_id)
 
-        self.data["x_predictors"].append(x_features)
-        self.data["x_labels"].append(label[0] / self.width)
+        if self.online:
+            last = len(self.samples) - 1
+            self.x_estimator.partial_fit(self.samples.get_features(X_COLUMNS)[last:], self.samples.get_labels(0)[last:])
+            self.y_estimator.partial_fit(self.samples.get_features(Y_COLUMNS)[last:], self.samples.get_labels(1)[last:])
 
-        self.data["y_predictors"].append(y_features)
-        self.data["y_labels"].append(label[1] / self.height)
+            self._compiled = compile_linear_model(self.x_estimator, self.y_estimator, self.width, self.height)
+            self._trained = True
 
     def train(self):
-        x_predictors = np.array(self.data["x_predictors"])
-        y_predictors = np.array(self.data["y_predictors"])
-        
-        x_labels = np.array(self.data["x_labels"])
-        y_labels = np.array(self.data["y_labels"])
+        if self.online:
+            self._trained = len(self.samples) > 0   # Already up to date with every sample
+            return
 
-        self.x_estimator.fit(x_predictors, x_labels)
-        self.y_estimator.fit(y_predictors, y_labels)
+        if self.joint_model is not None:
+            self.joint_model.fit(self.samples.get_features(), self.samples.get_labels())
+            self._trained = True
+            return
+
+        self.x_estimator.fit(self.samples.get_features(X_COLUMNS), self.samples.get_labels(0))
+        self.y_estimator.fit(self.samples.get_features(Y_COLUMNS), self.samples.get_labels(1))
 
+        self._compiled = compile_linear_model(self.x_estimator, self.y_estimator, self.width, self.height)
         self._trained = True
     
+    def _record_errors(self, x_residuals, y_residuals):
+        """
+        Records the mean squared x and y errors and the per-sample residuals, all as fractions of the screen size,
+        and returns the combined root mean squared distance in pixels
+        """
+
+        x_error = float(np.mean(x_residuals ** 2))
+        y_error = float(np.mean(y_residuals ** 2))
+
+        self.x_test_errors.append(x_error)
+        self.y_test_errors.append(y_error)
+        self._residuals = np.hypot(x_residuals * self.width, y_residuals * self.height)
+
+        return float(np.sqrt(x_error * self.width ** 2 + y_error * self.height ** 2))
+
+    def get_residuals(self):
+        """
+        Returns the screen points in pixels of the samples and the distance in pixels by which each one was missed
+        when test_data() last ran (held out when cross-validated), or (None, None) before that
+        """
+
+        residuals = self._residuals
+
+        if residuals is None:
+            return None, None
+
+        return self.samples.get_labels()[:len(residuals)] * self._bounds, residuals
+
     def test_data(self):
+        """
+        Records the current x and y errors and returns them combined as a root mean squared distance in pixels,
+        or None when there are too few samples to cross-validate yet
+        """
+
+        if self.joint_model is not None:
+            # Both axes share the hat matrix of the polynomial terms, so one pass gives both held out errors
+            features = self.samples.get_features()
+            labels = self.samples.get_labels()
+            degree, penalty = self.joint_model.select(features, labels)
+
+            terms = self.joint_model.expand(features, *get_standardization(features), degree)
+            residuals = cross_validation_residuals(terms, labels, penalty, self.cv_folds)
+
+            if residuals is None:
+                return None
+
+            return self._record_errors(residuals[:, 0], residuals[:, 1])
+
+        x_alpha = get_ridge_penalty(self.x_estimator)
+        y_alpha = get_ridge_penalty(self.y_estimator)
+
+        if x_alpha is not None and y_alpha is not None:
+            # Held out errors from the hat matrix, without touching the fitted estimators.
+            # Nothing is recorded until there are enough samples for every held out fit to be determined
+            x_residuals = cross_validation_residuals(self.samples.get_features(X_COLUMNS), self.samples.get_labels(0), x_alpha, self.cv_folds)
+            y_residuals = cross_validation_residuals(self.samples.get_features(Y_COLUMNS), self.samples.get_labels(1), y_alpha, self.cv_folds)
+
+            if x_residuals is None or y_residuals is None:
+                return None
+
+            return self._record_errors(x_residuals, y_residuals)
+
+        x_predictors = self.samples.get_features(X_COLUMNS)
+        y_predictors = self.samples.get_features(Y_COLUMNS)
         
-        x_predictors = np.array(self.data["x_predictors"])
-        y_predictors = np.array(self.data["y_predictors"])
-        
-        x_labels = np.array(self.data["x_labels"])
-        y_labels = np.array(self.data["y_labels"])
+        x_labels = self.samples.get_labels(0)
+        y_labels = self.samples.get_labels(1)
+
+        if self.online:
+            # Online estimators are already fit to every sample, refitting would throw their state away
+            return self._record_errors(self.x_estimator.predict(x_predictors) - x_labels, self.y_estimator.predict(y_predictors) - y_labels)
 
         self.x_estimator.fit(x_predictors, x_labels)
         self.y_estimator.fit(y_predictors, y_labels)
@@ -90,20 +300,141 @@ class GazeEstimation():
         x_predictions = self.x_estimator.predict(x_predictors)
         y_predictions = self.y_estimator.predict(y_predictors)
 
-        self.x_test_errors.append(mean_squared_error(x_predictions, x_labels))
-        self.y_test_errors.append(mean_squared_error(y_predictions, y_labels))
-
         self._trained = False
 
+        return self._record_errors(x_predictions - x_labels, y_predictions - y_labels)
+
     def predict(self, predictor):
+        gaze = self.predict_into(predictor, self._prediction)
+
+        return GazeState(int(gaze[0]), int(gaze[1]))
+
+    def predict_into(self, predictor, out):
+        """
+        Writes the gaze point in pixels, clipped to the screen, into the 2 element array out and returns it.
+        Compiled linear models and joint models do this without allocating, others go through their sklearn predict.
+        Only the tracking thread should call it for a joint model, which has a single set of scratch buffers
+        """
+
+        compiled = self._compiled
+
+        if self.joint_model is not None:
+            self.joint_model.predict_into(predictor, out)
+            out *= self._bounds
+        elif compiled is None:
+            predictor = np.asarray(predictor, dtype=np.double)
+
+            out[0] = self.x_estimator.predict(predictor[X_COLUMNS].reshape(1, -1))[0] * self.width
+            out[1] = self.y_estimator.predict(predictor[Y_COLUMNS].reshape(1, -1))[0] * self.height
+        else:
+            coefficients, intercepts = compiled
+
+            np.dot(coefficients, predictor, out=out)
+            out += intercepts
 
-        predictor.append(0)
+        return np.clip(out, 0, self._bounds, out=out)
 
-        x_features = np.array(predictor[0:-1:2]).reshape(1, -1)
-        y_features = np.array(predictor[1:-1:2]).reshape(1, -1)
+    def predict_batch(self, predictors, out=None):
+        """
+        Returns the gaze points in pixels for an (N, features) array of feature vectors as an (N, 2) array,
+        for replays and offline analysis
+        """
 
-        return GazeState(min(max(int(self.x_estimator.predict(x_features) * self.width), 0), self.width),
-                         min(max(int(self.y_estimator.predict(y_features) * self.height), 0), self.height))
+        predictors = np.asarray(predictors, dtype=np.double)
+
+        if out is None:
+            out = np.empty((len(predictors), 2), dtype=np.double)
+
+        compiled = self._compiled
+
+        if self.joint_model is not None:
+            out[:] = self.joint_model.predict(predictors)
+            out *= self._bounds
+        elif compiled is None:
+            out[:, 0] = self.x_estimator.predict(predictors[:, X_COLUMNS]) * self.width
+            out[:, 1] = self.y_estimator.predict(predictors[:, Y_COLUMNS]) * self.height
+        else:
+            coefficients, intercepts = compiled
+
+            np.dot(predictors, coefficients.T, out=out)
+            out += intercepts
+
+        return np.clip(out, 0, self._bounds, out=out)
     
+    def get_error(self, predictor, label):
+        """
+        Returns the distance in pixels between the predicted gaze point for predictor and the screen point label
+        """
+
+        gaze = self.predict_batch([predictor])[0]    # Callers are not the tracking thread, which owns predict_into's buffers
+
+        return float(np.hypot(gaze[0] - label[0], gaze[1] - label[1]))
+
+    def save_profile(self, path, camera_fingerprint=""):
+        """
+        Saves the calibration samples, the screen size and the camera fingerprint as an .npz file. The model itself is
+        not saved, load_profile() refits it from the samples
+        """
+
+        directory = os.path.dirname(path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            np.savez_compressed(f,
+                                version=PROFILE_VERSION,
+                                created=time.time(),
+                                screen_size=np.array([self.width, self.height]),
+                                camera_fingerprint=np.array(camera_fingerprint),
+                                features=self.samples.get_features(),
+                                labels=self.samples.get_labels(),
+                                timestamps=self.samples.get_timestamps(),
+                                frame_ids=self.samples.get_frame_ids())
+
+        os.replace(temporary_path, path)    # A crash while saving never leaves a truncated profile behind
+
+    def load_profile(self, path, camera_fingerprint=""):
+        """
+        Replaces the calibration with the one saved at path and fits the estimators to its samples. Returns False,
+        leaving the current calibration alone, when there is no profile or it was made for another screen size or camera.
+        The reason a profile is ignored is logged
+        """
+
+        if not os.path.exists(path):
+            return False
+
+        with np.load(path) as profile:
+            if int(profile["version"]) != PROFILE_VERSION:
+                logger.info("Ignoring calibration profile %s: unknown version", path)
+                return False
+
+            if tuple(profile["screen_size"]) != (self.width, self.height):
+                logger.info("Ignoring calibration profile %s: made for a %dx%d screen", path, *profile["screen_size"])
+                return False
+
+            if str(profile["camera_fingerprint"]) != camera_fingerprint:
+                logger.info("Ignoring calibration profile %s: made with camera %s", path, profile["camera_fingerprint"])
+                return False
+
+            if len(profile["labels"]) == 0:
+                logger.info("Ignoring calibration profile %s: it has no samples", path)
+                return False
+
+            self.clear_data()
+            self.samples.extend(profile["features"], profile["labels"], profile["timestamps"], profile["frame_ids"])
+
+        if self.online:
+            self.x_estimator.partial_fit(self.samples.get_features(X_COLUMNS), self.samples.get_labels(0))
+            self.y_estimator.partial_fit(self.samples.get_features(Y_COLUMNS), self.samples.get_labels(1))
+            self._compiled = compile_linear_model(self.x_estimator, self.y_estimator, self.width, self.height)
+
+        self.train()
+
+        return True
+
+    def get_sample_count(self):
+        return len(self.samples)
+
     def is_trained(self):
         return self._trained
@@ -5,86 +5,371 @@ EyePAINT
 By Dean Lawrence
 """
 
+import collections
 import threading
-import queue
-import cv2
 import time
 import numpy as np
 
-from . import GazeEstimation
+from . import GazeEstimation, GazeState
 from . import FeatureExtraction
+from .VisionPipeline import VisionPipeline
+from .DebugOverlay import DebugOverlay
+from .GazeChannel import GazeChannel
+from .Calibration import robust_mean
+from .GazeFilter import OneEuroFilter, FixationDetector
+from .Tracing import tracer
 
 class GazeEstimationThread():
-    def __init__(self, x_estimator, y_estimator, face_cascade_path, eye_cascade_path, shape_predictor_path, width, height):
+    def __init__(self, x_estimator, y_estimator, face_cascade_path, eye_cascade_path, shape_predictor_path, width, height, pipeline=False, display="debug", debug_fps=10, gaze_history=0,
+                 target_fps=30, cpu_budget=1.0, idle_timeout=2.0, max_idle_interval=0.5, time_samples=1000, stats_path=None, stats_interval=10,
+                 profiler=None, cv_folds=None, joint_model=None, gaze_filter=None, fixation_detector=None, fixation_history=64, **feature_options):
         
         self._width = width
         self._height = height
 
-        self._gaze_estimator = GazeEstimation(x_estimator, y_estimator, self._width, self._height)
-        self._feature_extractor = FeatureExtraction(face_cascade_path, eye_cascade_path, shape_predictor_path)
+        self._gaze_estimator = GazeEstimation(x_estimator, y_estimator, self._width, self._height, cv_folds, joint_model)
+        # "debug" shows the tracked features in a window at up to debug_fps, drawn off this thread, "headless" shows nothing
+        feature_options.setdefault("display", display != "headless")
+        feature_options.setdefault("capture_timeout", 3 / target_fps)   # A stalled camera holds the loop for a few frame periods at most
+        self._overlay = DebugOverlay(debug_fps) if display == "debug" else None
 
-        self._time_samples = []
-        self._gaze_queue = queue.Queue(0)
+        # Any extra keyword arguments (pupil_backend, face_tracking, ...) configure the feature extractor.
+        # With pipeline set, extraction runs as stages in separate processes instead of inside this thread
+        if pipeline:
+            self._feature_extractor = VisionPipeline(face_cascade_path, eye_cascade_path, shape_predictor_path, **feature_options)
+        else:
+            self._feature_extractor = FeatureExtraction(face_cascade_path, eye_cascade_path, shape_predictor_path, **feature_options)
+
+        self._time_samples = collections.deque(maxlen=time_samples)    # Most recent loop periods, for reports
+
+        # Stage timings are shared with the feature extractor, so one snapshot covers the whole loop.
+        # With stats_path set a snapshot is also written there every stats_interval seconds
+        self._stats = self._feature_extractor.latency_stats
+        self._stats.dump_path = stats_path
+        self._stats.dump_interval = stats_interval
+        self._gaze_channel = GazeChannel(gaze_history)    # Newest prediction, plus the last gaze_history ones if asked for
+        self._last_get_sequence = 0
+
+        # The loop runs once per captured frame, but no faster than target_fps and using at most cpu_budget of a core.
+        # When nobody has read gaze for idle_timeout seconds it backs off, doubling its sleep up to max_idle_interval
+        self._min_period = 1 / target_fps
+        self._cpu_budget = cpu_budget
+        self._idle_timeout = idle_timeout
+        self._max_idle_interval = max_idle_interval
+        self._idle_interval = self._min_period
+        self._last_consumer_time = time.perf_counter()
+        self._active = True
+        self._idling = False
+        self._wake = threading.Event()
+
+        self.last_prediction = None
+        self._gaze = np.empty(2, dtype=np.double)    # Per-frame gaze point before filtering
 
+        # Every frame's gaze point is smoothed by gaze_filter (a OneEuroFilter by default) and published, and
+        # fixation_detector (an I-DT FixationDetector by default) turns the smoothed points into fixation events,
+        # the last fixation_history of which are kept for get_fixations()
+        self._gaze_filter = gaze_filter if gaze_filter is not None else OneEuroFilter()
+        self._fixation_detector = fixation_detector if fixation_detector is not None else FixationDetector()
+        self._fixation_channel = GazeChannel(fixation_history)
+        self._last_fixation_sequence = 0
+        self._reset_filters = False  # Set when the model changes, the loop then resets both so no state carries over
+
+        self._profiler = profiler   # Optional ScopedProfiler that profiles this thread's loop
+
+        # The loop publishes a copy of each frame's feature vector with the frame's trace ID, replaced in one assignment,
+        # so other threads never read the extractor's buffers while they are being rewritten
+        self._features = (self._feature_extractor.get_state_as_vector().copy(), None)
+
+        # Between start_sample() and add_sample() the loop also appends each frame's vector here, replaced whole
+        # (never cleared in place) so a reader always sees one collection
+        self._collected = None
+
+        self._running = True
         self._thread = threading.Thread(target=self.run)
         self._thread.daemon = True
         self._thread.start()
 
-        self.last_prediction = None
-
     def run(self):
-        while True:
+        while self._running:
             start_time = time.time()
-            self._feature_extractor.update_feature_state(pupil_alpha=0.7)
-            self._feature_extractor.display_feature_state()
+            start_cpu_time = time.thread_time()     # CPU used by this thread, which waiting for a frame does not add to
+            if self._feature_extractor.update_feature_state(pupil_alpha=0.7) == -1:
+                if self._feature_extractor.is_finished():
+                    break   # A recorded source ran out of frames
+
+                continue
+
+            if self._profiler is not None:
+                self._profiler.tick()
+
+            if self._overlay is not None:
+                self._overlay.submit(self._feature_extractor.capture, self._feature_extractor.current_state)
+
+            trace_id, capture_time = self._feature_extractor.get_frame_trace()
+            features = self._feature_extractor.get_state_as_vector().copy()
+            self._features = (features, trace_id)
 
-            cv2.waitKey(1)
+            collected = self._collected
+            if collected is not None:
+                collected.append(features)
 
             #print(time.time())
 
             if self._gaze_estimator.is_trained():
-                prediction = self._gaze_estimator.predict(self._feature_extractor.get_state_as_vector())
+                with self._stats.span("regression"):
+                    gaze_x, gaze_y = self._gaze_estimator.predict_into(features, self._gaze)
+
+                timestamp = capture_time if capture_time is not None else time.perf_counter()
+
+                if self._reset_filters:
+                    self._reset_filters = False
+                    self._gaze_filter.reset()
+                    self._fixation_detector.reset()
+
+                with self._stats.span("filter"):
+                    gaze_x, gaze_y = self._gaze_filter.filter(self._gaze, timestamp)
+                    fixation = self._fixation_detector.update(gaze_x, gaze_y, timestamp, trace_id)
+
+                if fixation is not None:
+                    self._fixation_channel.put(fixation)
+                    self._stats.increment("fixations_ended" if fixation.ended else "fixations")
+
+                # The prediction carries its frame's trace ID and capture time on to whoever reads it
+                prediction = GazeState(int(gaze_x), int(gaze_y), trace_id, capture_time, self._fixation_detector.get_duration())
 
-                if self.last_prediction == None:
-                    self.last_prediction = prediction
-                    continue
+                with self._stats.span("handoff"):
+                    tracer.flow("t", prediction.trace_id, time.perf_counter(), "frame")   # Attaches to the handoff stage slice
+                    self._gaze_channel.put(prediction)
 
-                if np.sqrt((self.last_prediction.getX() - prediction.getX()) ** 2 + (self.last_prediction.getY() - prediction.getY()) ** 2) >= 300:
-                    self._gaze_queue.put(prediction)
-                    #print("Prediction: ", prediction.getX(), prediction.getY())
-                    #print("Last Prediction: ", self.last_prediction.getX(), self.last_prediction.getY())
-                    self.last_prediction = prediction
+                self._stats.increment("predictions")
+                self.last_prediction = prediction
 
-                #self._gaze_queue.put(prediction)
+                #self._gaze_channel.put(prediction)
 
-                end_time = time.time()
-                self._time_samples.append(end_time - start_time)
+            end_time = time.time()
+            self._time_samples.append(end_time - start_time)
+            self._stats.record("loop", end_time - start_time)
+
+            self._stats.set_counter("dropped_frames", self._feature_extractor.get_dropped_frames())
+            self._stats.maybe_dump()
+
+            self._pace(start_time, start_cpu_time)
+
+        if self._profiler is not None:
+            self._profiler.finish()     # Writes the profile if the run ended before its frame or time limit
+
+    def _pace(self, start_time, start_cpu_time):
+        """
+        Sleeps after an iteration to respect the frame rate cap and CPU budget, backing off while nobody reads gaze.
+        The budget counts this thread's CPU time, so time spent blocked waiting for the next frame is not throttled
+        """
+
+        elapsed = time.time() - start_time
+        delay = self._min_period - elapsed
+
+        if self._cpu_budget < 1:
+            # Long enough that the iteration's CPU time is at most cpu_budget of its whole period
+            delay = max(delay, (time.thread_time() - start_cpu_time) / self._cpu_budget - elapsed)
+
+        self._idling = not self._active or time.perf_counter() - self._last_consumer_time > self._idle_timeout
+
+        if self._idling:
+            delay = max(delay, self._idle_interval)
+            self._idle_interval = min(self._idle_interval * 2, self._max_idle_interval)
+        else:
+            self._idle_interval = self._min_period
+
+        if delay > 0:
+            self._wake.wait(delay)  # A returning consumer cuts an idle sleep short
+            self._wake.clear()
+
+    def _note_consumer(self):
+        self._last_consumer_time = time.perf_counter()
+
+        if self._idling:
+            self._wake.set()
+
+    def set_active(self, active):
+        """
+        Tells the loop whether gaze is needed right now. While inactive, for example while the robot paints,
+        it runs at the idle rate regardless of consumers
+        """
+
+        self._active = active
+        self._note_consumer()
 
     
     def get(self):
-        if self._gaze_queue.qsize() == 0:
+        """
+        Returns the newest prediction if one arrived since the last call, otherwise None
+        """
+
+        self._note_consumer()
+
+        sequence, prediction = self._gaze_channel.get_latest()
+
+        if sequence == self._last_get_sequence:
             return None
-        else:
-            return self._gaze_queue.get()
+
+        self._last_get_sequence = sequence
+
+        return prediction
+
+    def wait(self, timeout=None):
+        """
+        Waits for a prediction newer than the last one returned by get() or wait(), returning None on timeout
+        """
+
+        self._note_consumer()
+
+        latest = self._gaze_channel.wait(self._last_get_sequence, timeout)
+
+        if latest is None:
+            return None
+
+        self._last_get_sequence, prediction = latest
+
+        return prediction
+
+    def get_fixations(self):
+        """
+        Returns the FixationEvents (starts and ends of fixations) that were detected since the last call, oldest first
+        """
+
+        self._note_consumer()
+
+        events = self._fixation_channel.get_history(self._last_fixation_sequence)
+
+        if len(events) == 0:
+            return []
+
+        self._last_fixation_sequence = events[-1][0]
+
+        return [event for _, event in events]
+
+    def get_history(self, since_sequence=0):
+        """
+        Returns the (sequence, prediction) pairs kept in the bounded history, newer than since_sequence
+        """
+
+        return self._gaze_channel.get_history(since_sequence)
     
-    def add_sample(self, label):
-        self._gaze_estimator.add_sample(self._feature_extractor.get_state_as_vector(), label)
+    def start_sample(self):
+        """
+        Starts collecting the feature vector of every frame for the next add_sample(), for example once the user
+        has settled on a calibration dot
+        """
+
+        self._note_consumer()
+        self._collected = []
+
+    def add_sample(self, label, outlier_threshold=3.0):
+        """
+        Adds a calibration sample for the screen point label. If start_sample() was called, the sample is the mean of
+        the frames since then with outliers left out (see robust_mean), otherwise it is the current frame's features
+        """
+
+        self._note_consumer()
+        frame_id = self._features[1]
+
+        self._gaze_estimator.add_sample(self._take_collected(outlier_threshold), label, frame_id=-1 if frame_id is None else frame_id)
+
+    def _take_collected(self, outlier_threshold):
+        """
+        Ends the collection started by start_sample() and returns the robust mean of its frames, or the current
+        frame's features if nothing was collected
+        """
+
+        collected = self._collected
+        self._collected = None
+
+        if collected:
+            return robust_mean(collected, outlier_threshold)
+
+        return self._features[0]
 
     def train(self):
         self._gaze_estimator.train()
+        self._reset_filters = True
+
+    def clear_data(self):
+        self._gaze_estimator.clear_data()
+        self._reset_filters = True
+
+    def measure_drift(self, label, outlier_threshold=3.0):
+        """
+        Returns how far in pixels the gaze estimate is from label, the point the user is looking at. Like add_sample(),
+        it uses the robust mean of the frames since start_sample() if that was called, otherwise the current frame
+        """
+
+        self._note_consumer()
+        return self._gaze_estimator.get_error(self._take_collected(outlier_threshold), label)
+
+    def get_camera_fingerprint(self):
+        return self._feature_extractor.cap.get_fingerprint()
+
+    def save_profile(self, path):
+        """
+        Saves the calibration to path, tagged with this camera's fingerprint
+        """
+
+        self._gaze_estimator.save_profile(path, self.get_camera_fingerprint())
+
+    def load_profile(self, path):
+        """
+        Loads the calibration saved at path if it was made with this camera and screen size, returning whether it was
+        """
+
+        return self._gaze_estimator.load_profile(path, self.get_camera_fingerprint())
     
     def test_data(self):
-        self._gaze_estimator.test_data()
+        """
+        Records the calibration error and returns it as a root mean squared distance in pixels, None if there are too few samples
+        """
+
+        return self._gaze_estimator.test_data()
+
+    def get_residuals(self):
+        """
+        Returns the calibration dots in pixels and how far in pixels each was missed at the last test_data(), see GazeEstimation.get_residuals()
+        """
+
+        return self._gaze_estimator.get_residuals()
     
     def get_time_samples(self):
-        return self._time_samples
+        return list(self._time_samples)
+
+    def get_latency_snapshot(self):
+        """
+        Returns p50/p95/p99 and counts for each stage (capture, face, pose, eye_boxes, left_pupil, right_pupil,
+        regression, filter, handoff, loop) in seconds, along with the frame, prediction, fixation and dropped frame counters
+        """
+
+        return self._feature_extractor.get_latency_snapshot()
 
     def get_calibration_samples(self):
         return self._gaze_estimator.x_test_errors, self._gaze_estimator.y_test_errors
     
     def get_sample_count(self):
-        return len(self._gaze_estimator.data["x_labels"])
+        return self._gaze_estimator.get_sample_count()
     
     def is_trained(self):
         return self._gaze_estimator.is_trained()
 
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def release(self):
+        """
+        Stops the tracking loop and releases the camera and overlay
+        """
+
+        self._running = False
+        self._wake.set()
+        self._thread.join()
+
+        self._feature_extractor.release()
+
+        if self._overlay is not None:
+            self._overlay.release()
+
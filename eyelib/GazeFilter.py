@@ -0,0 +1,188 @@
+"""
+Gaze Filter
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import math
+import numpy as np
+
+class OneEuroFilter():
+    """
+    One Euro filter (Casiez et al. 2012) for the 2D gaze point: a low pass filter whose cutoff frequency rises with
+    the speed of the gaze. While the eyes hold still the cutoff stays near min_cutoff Hz and jitter is smoothed away,
+    during a saccade it rises by beta per pixel per second so the filtered point follows with little lag.
+    derivative_cutoff is the cutoff in Hz of the filter on the speed itself
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.007, derivative_cutoff=1.0):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.derivative_cutoff = derivative_cutoff
+
+        self._value = np.zeros(2, dtype=np.double)
+        self._velocity = np.zeros(2, dtype=np.double)
+        self._difference = np.empty(2, dtype=np.double)
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the filter state, the next point passes through unchanged
+        """
+
+        self._last_time = None
+
+    @staticmethod
+    def _get_alpha(cutoff, elapsed):
+        time_constant = 1 / (2 * math.pi * cutoff)
+
+        return 1 / (1 + time_constant / elapsed)
+
+    def filter(self, point, timestamp):
+        """
+        Filters the point seen at timestamp seconds and returns the filtered point, a 2 element array owned by
+        the filter that is rewritten on the next call
+        """
+
+        if self._last_time is None:
+            self._value[:] = point
+            self._velocity[:] = 0
+            self._last_time = timestamp
+
+            return self._value
+
+        elapsed = max(timestamp - self._last_time, 1e-6)
+        self._last_time = timestamp
+
+        difference = np.subtract(point, self._value, out=self._difference)
+
+        # Smoothed velocity, from which the cutoff for this step follows
+        difference /= elapsed
+        self._velocity += self._get_alpha(self.derivative_cutoff, elapsed) * (difference - self._velocity)
+        cutoff = self.min_cutoff + self.beta * math.hypot(self._velocity[0], self._velocity[1])
+
+        np.subtract(point, self._value, out=difference)
+        difference *= self._get_alpha(cutoff, elapsed)
+        self._value += difference
+
+        return self._value
+
+class FixationEvent():
+    """
+    A fixation found by FixationDetector: its centroid in pixels, when it started, how long it lasted so far, and the
+    trace ID of the frame that started it. ended is False for the event sent once the fixation is long enough to
+    count, and True for the one sent when the gaze leaves it
+    """
+
+    def __init__(self, x, y, start_time, duration, trace_id=None, ended=False):
+        self.x = x
+        self.y = y
+        self.start_time = start_time
+        self.duration = duration
+        self.trace_id = trace_id
+        self.ended = ended
+
+class FixationDetector():
+    """
+    Streaming dispersion threshold fixation detector that keeps a running centroid instead of a window of points.
+    Points within max_distance pixels of the centroid join it, and once it spans at least min_duration seconds it is
+    a fixation. A point further away is only an outlier, so noise and glitches do not split a fixation. exit_points
+    outliers in a row (the default is about 170 ms at 30 fps, long enough for a smoothed glitch to pass) end the
+    fixation, or the candidate before it counted as one, and a new candidate starts from them. Only the start point,
+    the point count, the running sums and the pending outliers are kept, so the state stays the same size however
+    long a fixation lasts
+    """
+
+    def __init__(self, max_distance=40, min_duration=0.1, exit_points=5):
+        self.max_distance = max_distance
+        self.min_duration = min_duration
+        self.exit_points = exit_points
+
+        self.reset()
+
+    def reset(self):
+        self._fixating = False
+        self._count = 0
+        self._pending = []  # Consecutive outliers (timestamp, x, y, trace_id), at most exit_points of them
+
+        # Start, latest time and running sums of the points in the fixation or candidate
+        self._start_time = None
+        self._start_trace_id = None
+        self._last_time = None
+        self._sum_x = 0.0
+        self._sum_y = 0.0
+
+    def _start(self, points):
+        self._fixating = False
+        self._start_time, _, _, self._start_trace_id = points[0]
+        self._count = 0
+        self._sum_x = 0.0
+        self._sum_y = 0.0
+
+        for timestamp, x, y, _ in points:
+            self._add(x, y, timestamp)
+
+    def _add(self, x, y, timestamp):
+        self._count += 1
+        self._sum_x += x
+        self._sum_y += y
+        self._last_time = timestamp
+
+    def _get_event(self, ended):
+        return FixationEvent(self._sum_x / self._count, self._sum_y / self._count, self._start_time,
+                             self._last_time - self._start_time, self._start_trace_id, ended)
+
+    def _check_start(self):
+        if not self._fixating and self._count > 1 and self._last_time - self._start_time >= self.min_duration:
+            self._fixating = True
+            return self._get_event(False)
+
+        return None
+
+    def get_duration(self):
+        """
+        Returns how long the current fixation has lasted in seconds, 0 when not fixating
+        """
+
+        if not self._fixating:
+            return 0.0
+
+        return self._last_time - self._start_time
+
+    def update(self, x, y, timestamp, trace_id=None):
+        """
+        Adds a gaze point and returns the FixationEvent it caused, the start or end of a fixation, or None
+        """
+
+        if self._count == 0:
+            self._start([(timestamp, x, y, trace_id)])
+            return None
+
+        if math.hypot(x - self._sum_x / self._count, y - self._sum_y / self._count) <= self.max_distance:
+            self._pending = []  # The outliers were noise
+            self._add(x, y, timestamp)
+
+            return self._check_start()
+
+        self._pending.append((timestamp, x, y, trace_id))
+
+        if len(self._pending) < self.exit_points:
+            return None
+
+        # The gaze has moved on: end the fixation and start over from the outliers if they hold together
+        event = self._get_event(True) if self._fixating else None
+        pending = self._pending
+        self._pending = []
+
+        xs = [p[1] for p in pending]
+        ys = [p[2] for p in pending]
+        center_x, center_y = sum(xs) / len(xs), sum(ys) / len(ys)
+
+        self._start([p for p in pending if math.hypot(p[1] - center_x, p[2] - center_y) <= self.max_distance] or pending[-1:])
+
+        if event is None:
+            event = self._check_start()
+
+        return event
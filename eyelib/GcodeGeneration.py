@@ -12,6 +12,7 @@ import math
 import pygame
 
 from . import Color, Tool
+from .Tracing import tracer
 
 class GcodeGeneration():
     def __init__(self, port, baud):
@@ -49,22 +50,26 @@ class GcodeGeneration():
         self._write_to_file(init_string)
         self._send(init_string)
 
-    def generate(self, point1, point2, color, tool):
+    def generate(self, point1, point2, color, tool, trace_id=None):
         """
-        Given two points, a color and a tool, the method generates the g-code string and sends it to the board
+        Given two points, a color and a tool, the method generates the g-code string and sends it to the board.
+        trace_id ties the generation and sending to the committed stroke in a trace
         """
 
-        complete_string = self._set(color)  # Add the color set routine to the current string
+        with tracer.span("gcode_generate", "stroke", {"trace_id": trace_id}, None if trace_id is None else ("t", trace_id)):
+            complete_string = self._set(color)  # Add the color set routine to the current string
 
-        if tool == Tool.Line:   # If the line tool is selected, add the line to current string
-            complete_string += self._line(point1, point2)
-        elif tool == Tool.Circle:   # If the circle tool is selected, add the circle to current string
-            complete_string += self._circle(point1, point2)
+            if tool == Tool.Line:   # If the line tool is selected, add the line to current string
+                complete_string += self._line(point1, point2)
+            elif tool == Tool.Circle:   # If the circle tool is selected, add the circle to current string
+                complete_string += self._circle(point1, point2)
 
-        complete_string += self._clean()    # Add the clean routine to current string
+            complete_string += self._clean()    # Add the clean routine to current string
 
-        self._write_to_file(complete_string)
-        self._send(complete_string)     # Send complete string to the SKR Pro
+            self._write_to_file(complete_string)
+
+        with tracer.span("gcode_send", "stroke", {"trace_id": trace_id}, None if trace_id is None else ("f", trace_id)):
+            self._send(complete_string)     # Send complete string to the SKR Pro
     
     def _line(self, point1, point2):
         """
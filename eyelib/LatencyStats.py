@@ -0,0 +1,171 @@
+"""
+Latency Stats
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import contextlib
+import json
+import math
+import time
+import numpy as np
+
+from .Tracing import tracer
+
+class LatencyHistogram():
+    """
+    Fixed size histogram of durations in the style of an HDR histogram. Buckets are spaced logarithmically,
+    bucket_resolution per doubling, between lowest and highest seconds, so every recorded value keeps the same
+    relative precision (about 4% with the default 16) and memory does not grow with the number of samples
+    """
+
+    def __init__(self, lowest=1e-6, highest=10.0, bucket_resolution=16):
+        self.lowest = lowest
+        self.bucket_resolution = bucket_resolution
+
+        bucket_count = int(math.ceil(math.log2(highest / lowest) * bucket_resolution)) + 1
+        self.counts = np.zeros(bucket_count, dtype=np.int64)
+
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = 0
+
+    def record(self, value):
+        if value <= self.lowest:
+            index = 0
+        else:
+            index = min(int(math.log2(value / self.lowest) * self.bucket_resolution), len(self.counts) - 1)
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def get_bucket_value(self, index):
+        """
+        Returns the upper edge of a bucket, so percentiles never understate a latency
+        """
+
+        return self.lowest * 2 ** ((index + 1) / self.bucket_resolution)
+
+    def get_percentiles(self, percentiles=(50, 95, 99)):
+        """
+        Returns the value at or below which each percentage of recorded samples fall, or None when nothing was recorded
+        """
+
+        counts = self.counts.copy()     # The tracking thread may keep recording while this runs
+        total = counts.sum()
+
+        if total == 0:
+            return [None for _ in percentiles]
+
+        cumulative = np.cumsum(counts)
+        indices = np.searchsorted(cumulative, [total * p / 100 for p in percentiles])
+
+        return [min(self.get_bucket_value(int(index)), self.max) for index in indices]
+
+    def snapshot(self):
+        p50, p95, p99 = self.get_percentiles((50, 95, 99))
+
+        return {"count": self.count,
+                "mean": self.total / self.count if self.count > 0 else None,
+                "min": self.min if self.count > 0 else None,
+                "max": self.max if self.count > 0 else None,
+                "p50": p50, "p95": p95, "p99": p99}
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0
+        self.min = math.inf
+        self.max = 0
+
+class LatencyStats():
+    """
+    A LatencyHistogram per named stage plus named counters. Stages are timed with span() or fed durations
+    with record(). With a dump_path set, maybe_dump() writes a JSON snapshot there every dump_interval seconds
+    """
+
+    def __init__(self, dump_path=None, dump_interval=10):
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+
+        self._histograms = {}
+        self._counters = {}
+        self._last_dump_time = time.perf_counter()
+
+    def get_histogram(self, name):
+        histogram = self._histograms.get(name)
+
+        if histogram is None:
+            histogram = self._histograms[name] = LatencyHistogram()
+
+        return histogram
+
+    def record(self, name, seconds):
+        self.get_histogram(name).record(seconds)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Times the body of a with statement into the named stage, and into the trace when tracing is enabled
+        """
+
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            self.get_histogram(name).record(end_time - start_time)
+            tracer.complete(name, start_time, end_time, "stage")
+
+    def increment(self, name, amount=1):
+        self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_counter(self, name, value):
+        """
+        Sets a counter that is kept elsewhere, such as a capture thread's dropped frame count
+        """
+
+        self._counters[name] = value
+
+    def snapshot(self):
+        """
+        Returns {"stages": {name: {count, mean, min, max, p50, p95, p99}}, "counters": {name: value}} with times in seconds
+        """
+
+        return {"time": time.time(),
+                "stages": {name: histogram.snapshot() for name, histogram in list(self._histograms.items())},
+                "counters": dict(self._counters)}
+
+    def dump(self, path=None):
+        with open(path or self.dump_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+    def maybe_dump(self):
+        """
+        Dumps a snapshot to dump_path if one is set and dump_interval seconds have passed since the last dump
+        """
+
+        if self.dump_path is None:
+            return False
+
+        now = time.perf_counter()
+
+        if now - self._last_dump_time < self.dump_interval:
+            return False
+
+        self._last_dump_time = now
+        self.dump()
+
+        return True
+
+    def reset(self):
+        for histogram in list(self._histograms.values()):
+            histogram.reset()
+
+        self._counters.clear()
@@ -0,0 +1,99 @@
+"""
+Online Regression
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import numpy as np
+
+class RecursiveLeastSquares():
+    """
+    Linear least squares regressor that is updated one sample at a time. Each partial_fit() row is folded into the
+    inverse of the regularized normal matrix with a Sherman-Morrison rank-one update in O(d^2), so the model is usable
+    after the first sample and never refit from scratch. With a forgetting_factor below 1 older samples are gradually
+    discounted, so the fit can follow slow drift during a session.
+
+    Follows the scikit-learn estimator interface (fit, partial_fit, predict, coef_, intercept_) so it can be used
+    anywhere the gaze estimators are. regularization is the ridge penalty the recursion starts from, small enough
+    that the result matches ordinary least squares once there are more samples than coefficients
+    """
+
+    def __init__(self, fit_intercept=True, regularization=1e-6, forgetting_factor=1.0):
+        self.fit_intercept = fit_intercept
+        self.regularization = regularization
+        self.forgetting_factor = forgetting_factor
+
+        self._size = None
+
+    def reset(self):
+        """
+        Forgets every sample, the next partial_fit() starts a new fit
+        """
+
+        self._size = None
+
+    def _start(self, feature_count):
+        size = feature_count + 1 if self.fit_intercept else feature_count
+        self._size = size
+
+        self._inverse = np.eye(size) / self.regularization   # Inverse of X'X + regularization * I
+        self._weights = np.zeros(size)
+
+        self._row = np.empty(size)
+        self._gain = np.empty(size)
+
+        self.coef_ = self._weights[:feature_count]
+        self.intercept_ = 0.0
+
+    def _augment(self, features):
+        self._row[:len(features)] = features
+
+        if self.fit_intercept:
+            self._row[-1] = 1
+
+        return self._row
+
+    def partial_fit(self, X, y):
+        """
+        Folds the rows of X with targets y into the fit
+        """
+
+        X = np.atleast_2d(np.asarray(X, dtype=np.double))
+        y = np.atleast_1d(np.asarray(y, dtype=np.double))
+
+        if self._size is None:
+            self._start(X.shape[1])
+
+        decay = self.forgetting_factor
+        inverse = self._inverse
+        gain = self._gain
+
+        for features, target in zip(X, y):
+            row = self._augment(features)
+
+            np.dot(inverse, row, out=gain)
+            gain /= decay + row @ gain
+
+            self._weights += gain * (target - row @ self._weights)
+
+            inverse -= np.outer(gain, row @ inverse)
+            inverse /= decay
+
+        self.intercept_ = self._weights[-1] if self.fit_intercept else 0.0
+
+        return self
+
+    def fit(self, X, y):
+        """
+        Starts over and fits the rows of X with targets y
+        """
+
+        self.reset()
+
+        return self.partial_fit(X, y)
+
+    def predict(self, X):
+        X = np.atleast_2d(np.asarray(X, dtype=np.double))
+
+        return X @ self.coef_ + self.intercept_
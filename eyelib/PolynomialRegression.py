@@ -0,0 +1,176 @@
+"""
+Polynomial Regression
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import numpy as np
+
+def get_standardization(features):
+    """
+    Returns the (center, scale) that standardizes each feature column, keeping constant columns unscaled
+    """
+
+    center = features.mean(axis=0)
+    scale = features.std(axis=0)
+    scale[scale < 1e-12] = 1
+
+    return center, scale
+
+def get_term_pairs(feature_count, degree):
+    """
+    Returns index arrays (first, second) of the feature pairs whose products are the second order terms
+    """
+
+    if degree < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+    first, second = np.triu_indices(feature_count)
+
+    return first.astype(np.intp), second.astype(np.intp)
+
+def get_loo_errors(terms, labels, penalties):
+    """
+    Returns the leave-one-out mean squared error, summed over the label columns, of a ridge fit with an unpenalized
+    constant for each penalty. Centering takes care of the constant, and one SVD of the centered terms gives the hat
+    matrix for every penalty, H = 11'/n + U diag(s^2 / (s^2 + penalty)) U', so each residual is e_i / (1 - H_ii)
+    """
+
+    count = len(terms)
+    centered_labels = labels - labels.mean(axis=0)
+    u, s, _ = np.linalg.svd(terms - terms.mean(axis=0), full_matrices=False)
+    projected = u.T @ centered_labels
+
+    errors = []
+    for penalty in penalties:
+        shrinkage = s ** 2 / (s ** 2 + penalty)
+        leverage = 1 / count + (u ** 2) @ shrinkage
+
+        if np.any(leverage > 1 - 1e-10):
+            errors.append(np.inf)   # Some sample is interpolated, its held out fit is undetermined
+            continue
+
+        residuals = centered_labels - u @ (shrinkage[:, None] * projected)
+        errors.append(np.mean(np.sum((residuals / (1 - leverage)[:, None]) ** 2, axis=1)))
+
+    return np.array(errors)
+
+class JointPolynomialModel():
+    """
+    Maps a whole feature vector to both screen coordinates at once with a polynomial of degree 1 or 2 in all
+    features (for the pupils, both coordinates of both eyes), so each axis can use cues from the other. Both outputs
+    are solved against one factorization of the ridge-regularized normal equations, and features are standardized
+    first to keep the products well conditioned.
+
+    regularization is the ridge penalty on every term but the constant. When it is None each fit picks it from
+    penalties, and the degree (up to degree) is picked too, both by the lowest closed-form leave-one-out error, so a
+    small calibration is not interpolated. Degree 2 is only considered once there are more samples than its terms
+    """
+
+    def __init__(self, degree=2, regularization=None, penalties=np.logspace(-4, 3, 15)):
+        self.degree = degree
+        self.regularization = regularization
+        self.penalties = penalties
+
+        self._model = None
+
+    def expand(self, features, center, scale, degree=None):
+        """
+        Returns the polynomial terms, without the constant, of each row of features after standardizing it, up to
+        degree (the configured degree by default)
+        """
+
+        if degree is None:
+            degree = self.degree
+
+        standardized = (np.atleast_2d(features) - center) / scale
+        first, second = get_term_pairs(standardized.shape[1], degree)
+
+        return np.hstack((standardized, standardized[:, first] * standardized[:, second]))
+
+    def select(self, features, labels):
+        """
+        Returns the (degree, penalty) a fit to these samples uses: the pair with the lowest leave-one-out error
+        """
+
+        features = np.asarray(features, dtype=np.double)
+        labels = np.asarray(labels, dtype=np.double)
+        center, scale = get_standardization(features)
+
+        penalties = self.penalties if self.regularization is None else [self.regularization]
+        best_error, best_degree, best_penalty = np.inf, 1, penalties[-1]
+
+        for degree in range(1, self.degree + 1):
+            terms = self.expand(features, center, scale, degree)
+
+            if degree > 1 and len(terms) <= terms.shape[1] + 1:
+                break   # No more samples than parameters, the fit would interpolate them
+
+            errors = get_loo_errors(terms, labels, penalties)
+            index = int(np.argmin(errors))
+
+            if errors[index] < best_error:
+                best_error, best_degree, best_penalty = errors[index], degree, penalties[index]
+
+        return best_degree, best_penalty
+
+    def fit(self, features, labels):
+        features = np.asarray(features, dtype=np.double)
+        labels = np.asarray(labels, dtype=np.double)
+
+        degree, regularization = self.select(features, labels)
+
+        center, scale = get_standardization(features)
+        terms = self.expand(features, center, scale, degree)
+        design = np.hstack((terms, np.ones((len(terms), 1))))
+
+        penalty = np.full(design.shape[1], regularization)
+        penalty[-1] = 0
+
+        # One LU factorization of the normal matrix serves both label columns
+        weights = np.linalg.solve(design.T @ design + np.diag(penalty), design.T @ labels)
+
+        feature_count = features.shape[1]
+        first, second = get_term_pairs(feature_count, degree)
+
+        # Scratch space for predict_into: the standardized features, both factors of each product, and the terms
+        # with a trailing 1 for the constant
+        buffers = (np.empty(feature_count), np.empty(len(first)), np.empty(len(first)), np.ones(design.shape[1]))
+
+        self._model = (center, scale, np.ascontiguousarray(weights.T), first, second, buffers, degree, regularization)   # Replaced in one assignment
+
+        return self
+
+    def is_fitted(self):
+        return self._model is not None
+
+    def predict(self, features):
+        """
+        Returns the (N, outputs) predictions for the rows of features
+        """
+
+        center, scale, weights, _, _, _, degree, _ = self._model
+        terms = self.expand(features, center, scale, degree)
+
+        return terms @ weights[:, :-1].T + weights[:, -1]
+
+    def predict_into(self, features, out):
+        """
+        Writes the prediction for a single feature vector into out without allocating. Not safe to call from
+        more than one thread at a time, since it shares its scratch buffers
+        """
+
+        center, scale, weights, first, second, buffers, _, _ = self._model
+        standardized, first_factors, second_factors, terms = buffers
+        feature_count = len(standardized)
+
+        np.subtract(features, center, out=standardized)
+        standardized /= scale
+
+        terms[:feature_count] = standardized
+        np.take(standardized, first, out=first_factors)
+        np.take(standardized, second, out=second_factors)
+        np.multiply(first_factors, second_factors, out=terms[feature_count:-1])
+
+        return np.dot(weights, terms, out=out)
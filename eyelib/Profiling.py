@@ -0,0 +1,164 @@
+"""
+Profiling
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import cProfile
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class SamplingProfiler():
+    """
+    Low overhead statistical profiler. A background thread looks at the profiled thread's stack every interval
+    seconds and counts each distinct stack, written out in the collapsed format used by flame graph tools
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._stacks = collections.Counter()
+        self._thread_id = None
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()     # Profile the thread that starts the profiler
+        self._running = True
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+
+            if len(stack) > 0:
+                self._stacks[";".join(reversed(stack))] += 1
+
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self._stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+class CProfileProfiler():
+    """
+    Deterministic profiler built on cProfile, written out as pstats. Before Python 3.12 it only sees the thread that
+    starts it. From 3.12 cProfile is built on sys.monitoring, so it sees every thread and only one can run per process
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, path):
+        self._profile.dump_stats(path)
+
+class ScopedProfiler():
+    """
+    Profiles the thread that calls tick() once per iteration of its loop. Profiling starts on the first tick and
+    stops after the given number of frames or seconds, whichever comes first, or when finish() is called.
+    Callers hold None instead of a profiler when profiling is off, so a disabled hook costs one comparison
+    """
+
+    def __init__(self, output_path, mode="cprofile", duration=None, frames=None, interval=0.005):
+        self.output_path = output_path
+        self.mode = mode
+        self.duration = duration
+        self.frames = frames
+        self.interval = interval
+
+        self._profiler = None
+        self._start_time = None
+        self._frame_count = 0
+        self._done = False
+        self.error = None   # Why the profiler could not start, if it could not
+
+    def tick(self):
+        if self._done:
+            return
+
+        if self._profiler is None:
+            self._profiler = SamplingProfiler(self.interval) if self.mode == "sample" else CProfileProfiler()
+
+            try:
+                self._profiler.start()
+            except ValueError as e:
+                # Another profiler already holds sys.monitoring's profiler slot (Python 3.12+)
+                self.error = str(e)
+                self._done = True
+                logger.warning("Profiler for %s not started: %s", self.output_path, e)
+                return
+
+            self._start_time = time.perf_counter()
+            return
+
+        self._frame_count += 1
+
+        if (self.frames is not None and self._frame_count >= self.frames) or \
+           (self.duration is not None and time.perf_counter() - self._start_time >= self.duration):
+            self.finish()
+
+    def finish(self):
+        """
+        Stops profiling and writes the output, if the profiler ran. Call it from the profiled thread. Returns whether
+        a profile was written by this call
+        """
+
+        if self._done or self._profiler is None:
+            return False
+
+        self._done = True
+        self._profiler.stop()
+        self._profiler.write(self.output_path)
+
+        logger.info("Wrote %s profile of %d frames over %.1fs to %s", self.mode, self._frame_count, time.perf_counter() - self._start_time, self.output_path)
+
+        return True
+
+def create_profilers(mode, scope, output_prefix="profile", duration=None, frames=None, interval=0.005):
+    """
+    Returns (tracking_profiler, gui_profiler) for a command line style configuration. mode is None, "cprofile"
+    or "sample" and scope is "tracking", "gui" or "both". Profilers outside the scope, or all of them when mode is None, are None.
+    Raises ValueError for cProfile with scope "both" on Python 3.12+, where only one cProfile can run per process
+    """
+
+    if mode is None:
+        return None, None
+
+    if mode == "cprofile" and scope == "both" and sys.version_info >= (3, 12):
+        raise ValueError("cProfile can only profile one loop at a time on Python 3.12+, choose the tracking or gui scope")
+
+    extension = ".folded" if mode == "sample" else ".prof"
+
+    def create(name):
+        if scope not in (name, "both"):
+            return None
+
+        return ScopedProfiler(output_prefix + "_" + name + extension, mode, duration, frames, interval)
+
+    return create("tracking"), create("gui")
@@ -0,0 +1,94 @@
+"""
+Sample Store
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import numpy as np
+
+class SampleStore():
+    """
+    Calibration samples kept in preallocated NumPy arrays: one row of features and one row of labels per sample,
+    with the time it was taken and the ID of the frame it came from. The arrays double in size when they fill up,
+    so appending is amortized O(1), and the getters return views of the filled rows without copying.
+    The feature count is taken from the first sample
+    """
+
+    def __init__(self, label_count=2, capacity=64):
+        self.label_count = label_count
+        self._initial_capacity = capacity
+
+        self.clear()
+
+    def clear(self):
+        self._count = 0
+        self._features = None
+        self._labels = np.empty((self._initial_capacity, self.label_count), dtype=np.double)
+        self._timestamps = np.empty(self._initial_capacity, dtype=np.double)
+        self._frame_ids = np.empty(self._initial_capacity, dtype=np.int64)
+
+    def __len__(self):
+        return self._count
+
+    def _reserve(self, count, feature_count):
+        if self._features is None:
+            self._features = np.empty((len(self._labels), feature_count), dtype=np.double)
+
+        capacity = len(self._labels)
+
+        if count <= capacity:
+            return
+
+        while capacity < count:
+            capacity *= 2
+
+        for name in ("_features", "_labels", "_timestamps", "_frame_ids"):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self._count] = old[:self._count]
+            setattr(self, name, new)
+
+    def append(self, features, labels, timestamp=0, frame_id=-1):
+        """
+        Copies one sample into the store. features may be a buffer the caller keeps reusing
+        """
+
+        self.extend(np.reshape(features, (1, -1)), np.reshape(labels, (1, -1)), [timestamp], [frame_id])
+
+    def extend(self, features, labels, timestamps, frame_ids):
+        """
+        Copies a batch of samples, one per row, into the store
+        """
+
+        count = len(labels)
+        self._reserve(self._count + count, np.shape(features)[1])
+
+        end = self._count + count
+        self._features[self._count:end] = features
+        self._labels[self._count:end] = labels
+        self._timestamps[self._count:end] = timestamps
+        self._frame_ids[self._count:end] = frame_ids
+        self._count = end
+
+    def get_features(self, columns=slice(None)):
+        """
+        Returns a view of the feature rows, of just the given columns (an index or slice) if set
+        """
+
+        if self._features is None:
+            return np.empty((0, 0), dtype=np.double)
+
+        return self._features[:self._count, columns]
+
+    def get_labels(self, column=slice(None)):
+        return self._labels[:self._count, column]
+
+    def get_timestamps(self):
+        return self._timestamps[:self._count]
+
+    def get_frame_ids(self):
+        return self._frame_ids[:self._count]
+
+    def get_capacity(self):
+        return len(self._labels)
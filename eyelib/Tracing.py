@@ -0,0 +1,139 @@
+"""
+Tracing
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import collections
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+
+FIRST_NEW_ID = 1 << 40   # Frame sequence numbers count up from 1 and stay far below this
+
+class TraceRecorder():
+    """
+    Collects timed events in the Chrome trace event format, so a run can be opened in chrome://tracing or Perfetto.
+    Each frame is followed by its trace ID (the frame sequence number) from capture through prediction to the GUI,
+    and each committed stroke by its own ID through g-code generation and sending, drawn as flow arrows in the viewer.
+    Every flow point of a kind has the same name, its category ("frame" or "stroke"), since viewers join the points of
+    an arrow by ID, category and name; the step is named by the slice it attaches to. Stroke IDs start at
+    FIRST_NEW_ID so they never collide with frame sequence numbers. All timestamps are time.perf_counter() seconds. While disabled every call returns right away.
+    The newest max_events events are kept
+    """
+
+    def __init__(self, max_events=100000):
+        self.enabled = False
+        self._events = collections.deque(maxlen=max_events)
+        self._ids = itertools.count(FIRST_NEW_ID)
+
+    def enable(self, max_events=None):
+        if max_events is not None:
+            self._events = collections.deque(self._events, maxlen=max_events)
+
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def new_id(self):
+        """
+        Returns a process-wide unique trace ID for work that does not start from a frame, such as a stroke. These
+        IDs start at FIRST_NEW_ID, far above any frame sequence number
+        """
+
+        return next(self._ids)
+
+    def _add(self, event, timestamp):
+        event["ts"] = timestamp * 1e6   # The format counts in microseconds
+        event["pid"] = os.getpid()
+        event["tid"] = threading.get_ident()
+        self._events.append(event)
+
+    def complete(self, name, start, end, category="eyepaint", args=None):
+        """
+        Records a slice from start to end
+        """
+
+        if not self.enabled:
+            return
+
+        event = {"name": name, "cat": category, "ph": "X", "dur": (end - start) * 1e6}
+
+        if args is not None:
+            event["args"] = args
+
+        self._add(event, start)
+
+    def flow(self, phase, trace_id, timestamp, category="eyepaint"):
+        """
+        Records one point of the flow arrow for trace_id, phase is "s" (start), "t" (step) or "f" (end).
+        The point is named after category, so every point of the arrow matches, and attaches to the slice on the
+        calling thread that encloses timestamp
+        """
+
+        if not self.enabled:
+            return
+
+        event = {"name": category, "cat": category, "ph": phase, "id": trace_id}
+
+        if phase == "f":
+            event["bp"] = "e"   # Bind to the enclosing slice rather than the next one
+
+        self._add(event, timestamp)
+
+    def point(self, name, trace_id, phase="t", category="eyepaint", args=None):
+        """
+        Records a short slice at the current time carrying a flow point for trace_id, for moments like a gaze
+        sample reaching the GUI that have no duration of their own
+        """
+
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        self.complete(name, now, now + 1e-6, category, args)
+        self.flow(phase, trace_id, now, category)
+
+    @contextlib.contextmanager
+    def span(self, name, category="eyepaint", args=None, flow=None):
+        """
+        Records the body of a with statement as a slice. flow is an optional (phase, trace_id) pair to attach a flow
+        point for that ID to the slice
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            self.complete(name, start_time, end_time, category, args)
+
+            if flow is not None:
+                self.flow(flow[0], flow[1], start_time, category)
+
+    def get_events(self):
+        return list(self._events)
+
+    def export(self, path):
+        """
+        Writes the recorded events to path as Chrome trace event JSON
+        """
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.get_events(), "displayTimeUnit": "ms"}, f)
+
+    def clear(self):
+        self._events.clear()
+
+# Shared by every part of the program, so a trace ID can be followed across modules without passing a recorder around
+tracer = TraceRecorder()
@@ -0,0 +1,323 @@
+"""
+Vision Pipeline
+EyePAINT
+
+By Dean Lawrence
+"""
+
+import collections
+import multiprocessing
+import queue
+import threading
+import time
+import numpy as np
+
+from .FeatureExtraction import HeadDetector, PupilDetector, Frame, FEATURE_STATE_DTYPE, create_feature_state, get_detector_options, state_to_vector
+from .FrameSources import CameraSource
+from .LatencyStats import LatencyStats
+from .Tracing import tracer
+
+class SharedFrameRing():
+    """
+    A fixed number of frame sized slots in a multiprocessing.shared_memory block, so frames can be handed
+    between processes by slot number instead of being pickled
+    """
+
+    def __init__(self, slots, shape, name=None):
+        from multiprocessing import shared_memory   # Python 3.8+, only needed when the pipeline is used
+
+        self.slots = slots
+        self.shape = tuple(shape)
+        self._owner = name is None
+
+        size = slots * int(np.prod(self.shape))
+
+        if self._owner:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            try:
+                self._memory = shared_memory.SharedMemory(name=name, track=False)   # Only the owner should unlink the block
+            except TypeError:
+                self._memory = shared_memory.SharedMemory(name=name)    # Python < 3.13 has no track argument
+
+        self._frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self._memory.buf)
+
+    def get_name(self):
+        return self._memory.name
+
+    def get(self, slot):
+        return self._frames[slot]
+
+    def close(self):
+        del self._frames
+        self._memory.close()
+
+        if self._owner:
+            self._memory.unlink()
+
+def _run_head_stage(shape_predictor_path, head_options, ring_name, slots, shape, input_queue, output_queue):
+    """
+    Stage process that finds the face, pose and eye boxes of each frame in the ring
+    """
+
+    ring = SharedFrameRing(slots, shape, name=ring_name)
+    detector = HeadDetector(shape_predictor_path, **head_options)
+    state = create_feature_state()
+
+    while True:
+        item = input_queue.get()
+
+        if item is None:
+            output_queue.put(None)  # Pass the shutdown along to the next stage
+            break
+
+        slot, sequence, timestamp, alphas, timings = item
+
+        start_time = time.perf_counter()
+        detector.update(Frame(ring.get(slot), timestamp, sequence), state, alphas["face_alpha"], alphas["eye_alpha"], alphas["pose_alpha"])
+        timings = timings + (("head", time.perf_counter() - start_time),)
+
+        output_queue.put((slot, sequence, timestamp, alphas, timings, state.tobytes()))
+
+    ring.close()
+
+def _run_pupil_stage(pupil_options, ring_name, slots, shape, input_queue, output_queue, free_slots):
+    """
+    Stage process that finds the pupils inside the eye boxes from the head stage and releases the frame's slot
+    """
+
+    ring = SharedFrameRing(slots, shape, name=ring_name)
+    detector = PupilDetector(**pupil_options)
+    state = create_feature_state()
+
+    while True:
+        item = input_queue.get()
+
+        if item is None:
+            output_queue.put(None)
+            break
+
+        slot, sequence, timestamp, alphas, timings, head_state = item
+
+        start_time = time.perf_counter()
+        head_state = np.frombuffer(head_state, dtype=FEATURE_STATE_DTYPE)[0]
+        for field in ("face", "right_eye", "left_eye", "pose"):
+            state[field] = head_state[field]    # Pupils keep this stage's own smoothed history
+
+        detector.update(Frame(ring.get(slot), timestamp, sequence), state, alphas["pupil_alpha"])
+        free_slots.put(slot)
+        timings = timings + (("pupil", time.perf_counter() - start_time),)
+
+        output_queue.put((sequence, timestamp, timings, state.tobytes()))
+
+    ring.close()
+
+class VisionPipeline():
+    """
+    Runs feature extraction as stages in separate processes: capture (a thread in this process), head detection
+    and pupil detection. Consecutive frames overlap across the stages, and frames move between them through a
+    ring of shared memory slots. A frame only enters the pipeline when a slot is free, so the number of frames
+    in flight, and with it the per-frame latency, stays bounded. Live frames that arrive while every slot is busy
+    are dropped.
+
+    Each stage process builds only its own detector (HeadDetector or PupilDetector) from the FeatureExtraction keyword
+    options that detector takes, so neither loads the other's models. The cascade paths are accepted to match
+    FeatureExtraction but not used, since neither stage needs the Haar cascades.
+
+    Exposes the parts of the FeatureExtraction interface used by GazeEstimationThread
+    """
+
+    def __init__(self, face_cascade_path, eye_cascade_path, shape_predictor_path, source=None, slots=4, latency_samples=1000, display=False, capture_timeout=0.1,
+                 first_frame_timeout=5.0, **feature_options):
+        self.cap = source if source is not None else CameraSource(0)
+        self.capture_timeout = capture_timeout  # Default wait for a finished frame in update_feature_state()
+
+        self.current_state = create_feature_state()
+        self.capture = None     # Frames stay in the stage processes, so there is no image to show an overlay on
+        self._state_vector = np.empty(4, dtype=np.double)
+        self._alphas = {"face_alpha": 0.15, "eye_alpha": 1, "pupil_alpha": 0.3, "pose_alpha": 0.7}
+
+        self.latest_timings = ()
+        self._frame_trace = (None, None)
+        self._latencies = collections.deque(maxlen=latency_samples)
+        self.latency_stats = LatencyStats()
+        self._dropped_frames = 0
+        self._finished = False
+
+        # The ring is sized from the first frame. A camera never finishes, so a missing or busy one is given up on
+        # after first_frame_timeout seconds instead of being retried forever
+        deadline = time.perf_counter() + first_frame_timeout
+        ret, image = self.cap.read()
+        while not ret and not self.cap.finished:
+            if time.perf_counter() > deadline:
+                self.cap.release()
+                raise RuntimeError("No frame from the source within {} seconds, is the camera connected and free?".format(first_frame_timeout))
+
+            time.sleep(0.01)
+            ret, image = self.cap.read()
+
+        self._first_image = image if ret else None
+        shape = image.shape if ret else (1, 1, 3)
+
+        self._ring = SharedFrameRing(slots, shape)
+
+        # Spawned processes behave the same on every platform and do not inherit this process's threads
+        context = multiprocessing.get_context("spawn")
+        self._free_slots = context.Queue()
+        self._head_queue = context.Queue()
+        self._pupil_queue = context.Queue()
+        self._output_queue = context.Queue()
+
+        for slot in range(slots):
+            self._free_slots.put(slot)
+
+        head_options = get_detector_options(HeadDetector, feature_options)
+        pupil_options = get_detector_options(PupilDetector, feature_options)
+
+        self._processes = [context.Process(target=_run_head_stage,
+                                           args=(shape_predictor_path, head_options, self._ring.get_name(), slots, shape, self._head_queue, self._pupil_queue)),
+                           context.Process(target=_run_pupil_stage,
+                                           args=(pupil_options, self._ring.get_name(), slots, shape, self._pupil_queue, self._output_queue, self._free_slots))]
+
+        for process in self._processes:
+            process.daemon = True
+            process.start()
+
+        self._running = True
+        self._capture_thread = threading.Thread(target=self._run_capture)
+        self._capture_thread.daemon = True
+        self._capture_thread.start()
+
+    def _run_capture(self):
+        image = self._first_image
+        timestamp = time.perf_counter()
+        sequence = 1
+
+        while self._running:
+            if image is None:
+                ret, image = self.cap.read()
+
+                if not ret:
+                    image = None
+
+                    if self.cap.finished:
+                        break
+
+                    continue
+
+                timestamp = time.perf_counter()
+                sequence += 1
+
+            try:
+                # Live sources drop frames when the pipeline is full, replays wait so every frame is processed
+                slot = self._free_slots.get(block=not self.cap.is_live, timeout=None if self.cap.is_live else 1.0)
+            except queue.Empty:
+                if self.cap.is_live:
+                    self._dropped_frames += 1
+                    image = None
+
+                continue
+
+            start_time = time.perf_counter()
+            np.copyto(self._ring.get(slot), image)
+            timings = (("capture", time.perf_counter() - start_time),)
+
+            self._head_queue.put((slot, sequence, timestamp, dict(self._alphas), timings))
+            image = None
+
+        self._head_queue.put(None)
+
+    def update_feature_state(self, face_alpha=0.15, eye_alpha=1, pupil_alpha=0.3, pose_alpha=0.7, timeout=None):
+        """
+        Takes the next finished frame from the pipeline into current_state. For live sources older finished
+        frames that are still waiting are skipped and counted as dropped, so the newest one is always used
+        """
+
+        self._alphas = {"face_alpha": face_alpha, "eye_alpha": eye_alpha, "pupil_alpha": pupil_alpha, "pose_alpha": pose_alpha}
+
+        if self._finished:
+            return -1
+
+        try:
+            result = self._output_queue.get(timeout=timeout if timeout is not None else self.capture_timeout)
+        except queue.Empty:
+            if not all(process.is_alive() for process in self._processes):
+                self._finished = True   # A stage died, no more results will arrive
+
+            self.latency_stats.increment("missed_frames")
+            return -1
+
+        while result is not None and self.cap.is_live:
+            try:
+                newer = self._output_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            self._dropped_frames += 1
+            result = newer
+
+        if result is None:
+            self._finished = True
+            return -1
+
+        sequence, timestamp, timings, state = result
+
+        self.current_state[...] = np.frombuffer(state, dtype=FEATURE_STATE_DTYPE)[0]
+        self.latest_timings = timings
+        self._frame_trace = (sequence, timestamp)
+
+        latency = time.perf_counter() - timestamp
+        tracer.point("pipeline_result", sequence, "s", "frame", {"trace_id": sequence, "latency_ms": latency * 1000, "stages_ms": {stage: duration * 1000 for stage, duration in timings}})
+        self._latencies.append(latency)
+
+        for stage, duration in timings:
+            self.latency_stats.record(stage, duration)
+
+        self.latency_stats.record("pipeline", latency)  # Capture to result, including time spent waiting between stages
+        self.latency_stats.increment("frames")
+
+        return 1
+
+    def get_state_as_vector(self):
+        return state_to_vector(self.current_state, self._state_vector)
+
+    def get_latency_samples(self):
+        """
+        Returns the recent capture-to-result latencies in seconds
+        """
+
+        return list(self._latencies)
+
+    def get_dropped_frames(self):
+        return self._dropped_frames
+
+    def get_frame_trace(self):
+        """
+        Returns the trace ID (sequence number) and capture time of the frame current_state was last updated from
+        """
+
+        return self._frame_trace
+
+    def get_latency_snapshot(self):
+        """
+        Returns the per-stage latency percentiles and frame counters, see LatencyStats.snapshot()
+        """
+
+        self.latency_stats.set_counter("dropped_frames", self._dropped_frames)
+
+        return self.latency_stats.snapshot()
+
+    def is_finished(self):
+        return self._finished
+
+    def release(self):
+        self._running = False
+        self._capture_thread.join()
+
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        self._ring.close()
+        self.cap.release()
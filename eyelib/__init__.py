@@ -6,7 +6,20 @@ By Dean Lawrence
 """
 
 from eyelib.GUIElements import *
+from eyelib.CaptureThread import *
+from eyelib.Tracing import *
+from eyelib.Profiling import *
+from eyelib.LatencyStats import *
+from eyelib.FrameSources import *
 from eyelib.FeatureExtraction import *
+from eyelib.OnlineRegression import *
+from eyelib.SampleStore import *
+from eyelib.PolynomialRegression import *
+from eyelib.Calibration import *
 from eyelib.GazeEstimation import *
 from eyelib.GcodeGeneration import *
+from eyelib.VisionPipeline import *
+from eyelib.DebugOverlay import *
+from eyelib.GazeChannel import *
+from eyelib.GazeFilter import *
 from eyelib.GazeEstimationThread import *
@@ -8,10 +8,13 @@ import pygame
 import enum
 import math
 import argparse
+import logging
+import time
 from sklearn import linear_model
 
-from eyelib import GazeEstimationThread, GazeState
+from eyelib import GazeEstimationThread, GazeState, AdaptiveCalibration, get_profile_path
 from eyelib import GcodeGeneration
+from eyelib import tracer, create_profilers
 from eyelib import ProgramState, Color, Tool, Text, ColorButton, Canvas, CanvasButton, BrushStroke, CalibrationDot
 
 
@@ -21,22 +24,57 @@ class MockGazeEstimationThread():
 
         return GazeState(pos[0], pos[1])
     
+    def start_sample(self):
+        pass
+
     def add_sample(self, pos):
         pass
 
     def train(self):
         pass
 
+    def test_data(self):
+        return None
+
+    def get_residuals(self):
+        return None, None
+
+    def set_active(self, active):
+        pass
+
+    def clear_data(self):
+        pass
+
+    def measure_drift(self, label):
+        return 0
+
+    def save_profile(self, path):
+        pass
+
+    def load_profile(self, path):
+        return False
+
+    def release(self):
+        pass
+
 class MockGcodeGeneration():
     def initialize(self):
         pass
 
-    def generate(self, point1, point2, color, tool):
+    def generate(self, point1, point2, color, tool, trace_id=None):
         pygame.time.delay(4000)
 
 class App():
-    def __init__(self, width, height, canvas_divisions=10, calibration_dots=4, port="COM3"):
+    def __init__(self, width, height, canvas_divisions=10, calibration_dots=4, port="COM3", trace_path=None, tracking_profiler=None, gui_profiler=None,
+                 user="default", profile_dir="./profiles", recalibrate=False, drift_threshold=None, adaptive=False, target_error=None, mock_tracking=False, display="headless"):
         self._running = True
+        self.gui_profiler = gui_profiler
+
+        # With a trace path, frames and strokes are traced from capture and commit to the CNC, and exported on exit
+        self.trace_path = trace_path
+        if trace_path is not None:
+            tracer.enable()
+
         self._screen = None
         self.size = self.width, self.height = width, height     # Hardcoded dimensions for the window
         
@@ -106,20 +144,45 @@ class App():
     
         # Object that runs the gaze estimation in a separate thread
         # Deposits predictions into a queue that can be accessed through get()
-        
-        """
-        self.gaze_estimation = GazeEstimationThread(x_estimator=linear_model.LinearRegression(),
-                                                    y_estimator=linear_model.LinearRegression(),
-                                                    face_cascade_path="./classifiers/haarcascade_frontalface_default.xml",
-                                                    eye_cascade_path="./classifiers/haarcascade_eye.xml",
-                                                    shape_predictor_path="./classifiers/shape_predictor_68_face_landmarks.dat",
-                                                    width=self.width,
-                                                    height=self.height)
-        """
+        # With mock_tracking the mouse stands in for gaze, so nothing is tracked, profiled or calibrated.
+        # The tracking overlay window is only shown with display="debug", the kiosk runs headless
+        if mock_tracking:
+            self.gaze_estimation = MockGazeEstimationThread()
+        else:
+            self.gaze_estimation = GazeEstimationThread(x_estimator=linear_model.LinearRegression(),
+                                                        y_estimator=linear_model.LinearRegression(),
+                                                        face_cascade_path="./classifiers/haarcascade_frontalface_default.xml",
+                                                        eye_cascade_path="./classifiers/haarcascade_eye.xml",
+                                                        shape_predictor_path="./classifiers/shape_predictor_68_face_landmarks.dat",
+                                                        width=self.width,
+                                                        height=self.height,
+                                                        display=display,
+                                                        profiler=tracking_profiler)
         
         self.gcode_generation = GcodeGeneration(port, 250000)
         #self.gcode_generation = MockGcodeGeneration()
-        self.gaze_estimation = MockGazeEstimationThread()
+
+        # A user's saved calibration is reused after a quick drift check of a few dots. If the estimate has drifted
+        # further than drift_threshold pixels from them, or there is no matching profile, the full calibration runs
+        self.profile_path = get_profile_path(profile_dir, user)
+        self.drift_threshold = drift_threshold if drift_threshold is not None else self.height / 10
+        self.drift_errors = []
+
+        # Adaptive calibration shows one dot at a time where the fit is least certain, and stops as soon as the
+        # cross-validated error is within target_error pixels instead of always showing the whole grid
+        self.adaptive_calibration = None
+        if adaptive:
+            self.adaptive_calibration = AdaptiveCalibration(self.width, self.height, calibration_dots,
+                                                            target_error if target_error is not None else self.height / 20)
+            self.button_dict[ProgramState.Calibration] = [CalibrationDot(*self.adaptive_calibration.next_point(), 65)]
+
+        self.full_calibration = self.button_dict[ProgramState.Calibration]
+        self.drift_check = not recalibrate and self.gaze_estimation.load_profile(self.profile_path)
+
+        if self.drift_check:
+            self.button_dict[ProgramState.Calibration] = [CalibrationDot(self.width * (1/2), self.height * (1/2), 65),
+                                                          CalibrationDot(self.width * (1/4), self.height * (1/4), 65),
+                                                          CalibrationDot(self.width * (3/4), self.height * (3/4), 65)]
     
     def init(self):
         pygame.init()   # Init pygame stuff
@@ -156,6 +219,10 @@ class App():
 
         if gaze_location != None:   # If there was a location, update the classes known location
             self.gaze_state = gaze_location
+
+            if tracer.enabled and gaze_location.trace_id is not None:
+                tracer.point("gui_gaze", gaze_location.trace_id, "f", "frame",
+                             {"trace_id": gaze_location.trace_id, "latency_ms": (time.perf_counter() - gaze_location.capture_time) * 1000})
         
         if self.gaze_state == None and self.state != ProgramState.Calibration:
             return
@@ -164,7 +231,7 @@ class App():
         if self.state == ProgramState.Calibration:
             
             if self.active_calibration_dot == -1:
-                pygame.time.delay(4000)
+                pygame.time.delay(1000 if self.drift_check else 4000)
                 self.active_calibration_dot += 1
             
             dot = self.button_dict[self.state][self.active_calibration_dot]
@@ -174,13 +241,45 @@ class App():
             
             dot.decrement()
 
+            if dot.get_step() == dot.set_steps // 2:
+                self.gaze_estimation.start_sample()     # The user has settled on the dot, average the frames from here on
+
             if dot.get_step() == 0:
                 dot.crad = 0
-                self.gaze_estimation.add_sample((dot.get_x(), dot.get_y()))
-                self.active_calibration_dot += 1
+                if self.drift_check:
+                    self.drift_errors.append(self.gaze_estimation.measure_drift((dot.get_x(), dot.get_y())))
+                    self.active_calibration_dot += 1
+                elif self.adaptive_calibration is not None:
+                    self.gaze_estimation.add_sample((dot.get_x(), dot.get_y()))
+
+                    error = self.gaze_estimation.test_data()
+
+                    if self.adaptive_calibration.add_error(error, *self.gaze_estimation.get_residuals()):
+                        self.active_calibration_dot += 1    # Accurate enough, or out of dots
+                    else:
+                        self.button_dict[self.state][self.active_calibration_dot] = CalibrationDot(*self.adaptive_calibration.next_point(), 65)
+                else:
+                    self.gaze_estimation.add_sample((dot.get_x(), dot.get_y()))
+                    self.active_calibration_dot += 1
+
+            if self.active_calibration_dot == len(self.button_dict[self.state]):
+                if self.drift_check:
+                    self.drift_check = False
+
+                    if sum(self.drift_errors) / len(self.drift_errors) > self.drift_threshold:
+                        # The saved calibration no longer fits, start over with the full dot sequence
+                        self.gaze_estimation.clear_data()
+                        self.button_dict[ProgramState.Calibration] = self.full_calibration
+
+                        if self.adaptive_calibration is not None:
+                            self.adaptive_calibration.reset()
+                            self.full_calibration[0] = CalibrationDot(*self.adaptive_calibration.next_point(), 65)
+                        self.active_calibration_dot = -1
+                        return
+                else:
+                    self.gaze_estimation.train()        # Train the regressors that perform gaze estimation
+                    self.gaze_estimation.save_profile(self.profile_path)
 
-            if self.active_calibration_dot == self.calibration_dots * self.calibration_dots:
-                self.gaze_estimation.train()        # Train the regressors that perform gaze estimation
                 self.gcode_generation.initialize()  # Send the initialization string for the CNC
                 self.state = ProgramState.Primary   # Switch to the primary screen
 
@@ -249,7 +348,12 @@ class App():
                         x2 = (x2 - ((self.width-self.height)/2)) / self.height
                         y2 /= self.height
                         
-                        self.gcode_generation.generate((x1, y1), (x2, y2), self.active_color, self.active_tool)     # Generate and send g-code string to CNC
+                        self.gaze_estimation.set_active(False)  # Let tracking idle while the CNC paints, nothing reads gaze meanwhile
+
+                        stroke_id = tracer.new_id()
+                        with tracer.span("commit_stroke", "stroke", {"trace_id": stroke_id}, ("s", stroke_id)):
+                            self.gcode_generation.generate((x1, y1), (x2, y2), self.active_color, self.active_tool, trace_id=stroke_id)     # Generate and send g-code string to CNC
+                        self.gaze_estimation.set_active(True)
                         
                     #Reset the canvas for next brush stroke and move back to primary
                     self.pointOne = (0, 0)
@@ -353,6 +457,14 @@ class App():
     def cleanup(self):
         pygame.quit()   # Quit pygame stuff
 
+        self.gaze_estimation.release()  # Stops tracking, which also writes its profile if one is running
+
+        if self.gui_profiler is not None:
+            self.gui_profiler.finish()
+
+        if self.trace_path is not None:
+            tracer.export(self.trace_path)  # Open in chrome://tracing or ui.perfetto.dev
+
     def execute(self):
         """
         Main loop method of the program
@@ -368,6 +480,9 @@ class App():
             self.loop()         # Call loop method that updates the logic of the program
             self.render()       # Render method that clears screen and redraws buttons
 
+            if self.gui_profiler is not None:
+                self.gui_profiler.tick()
+
             pygame.time.delay(60)   # Delay to run at about 60 updates per second
         
         self.cleanup()  # Cleanup and exit pygame
@@ -381,8 +496,31 @@ if __name__ == "__main__":
     parser.add_argument("--canvas_divisions", type=int, default=8, help="Number divisions for the canvas")
     parser.add_argument("--calibration_dots", type=int, default=4, help="Width and height of calibration dot matrix")
     parser.add_argument("--port", type=str, default="COM3", help="Serial port to open connection to CNC with")
+    parser.add_argument("--profile", type=str, default=None, choices=["cprofile", "sample"], help="Profile with cProfile (pstats output) or the sampling profiler (collapsed stacks)")
+    parser.add_argument("--profile_scope", type=str, default="both", choices=["tracking", "gui", "both"], help="Which loop to profile, on Python 3.12+ cprofile can only profile one of them")
+    parser.add_argument("--profile_duration", type=float, default=None, help="Stop profiling after this many seconds")
+    parser.add_argument("--profile_frames", type=int, default=None, help="Stop profiling after this many loop iterations")
+    parser.add_argument("--profile_output", type=str, default="profile", help="Prefix for profile files, written as <prefix>_tracking and <prefix>_gui")
+    parser.add_argument("--user", type=str, default="default", help="Name of the calibration profile to load and save")
+    parser.add_argument("--profile_dir", type=str, default="./profiles", help="Directory calibration profiles are kept in")
+    parser.add_argument("--recalibrate", action="store_true", help="Run the full calibration even if a saved profile matches")
+    parser.add_argument("--drift_threshold", type=float, default=None, help="Mean error in pixels over the drift check dots above which a saved profile is recalibrated, defaults to a tenth of the height")
+    parser.add_argument("--adaptive", action="store_true", help="Place calibration dots adaptively, near the worst fit dots, and stop once the calibration error is within --target_error. Needs the camera tracker, with --mock_tracking every grid dot is shown")
+    parser.add_argument("--target_error", type=float, default=None, help="Cross-validated error in pixels that ends adaptive calibration, defaults to a twentieth of the height")
+    parser.add_argument("--display", type=str, default="headless", choices=["debug", "headless"], help="Show the rate-limited tracking overlay window or run without one")
+    parser.add_argument("--mock_tracking", action="store_true", help="Use the mouse position as gaze instead of tracking the eyes with the camera")
+    parser.add_argument("--trace", type=str, default=None, help="Record a Chrome trace event JSON file of frame and stroke latencies to this path")
 
     args = parser.parse_args()
 
-    app = App(args.width, args.height, canvas_divisions=args.canvas_divisions, calibration_dots=args.calibration_dots, port=args.port)    # Initialize the app at a size of 1600 pixels wide and 900 pixels high
+    logging.basicConfig(level=logging.INFO, format="%(message)s")   # Shows why a calibration profile was ignored and where profiles were written
+
+    try:
+        tracking_profiler, gui_profiler = create_profilers(args.profile, args.profile_scope, args.profile_output, args.profile_duration, args.profile_frames)
+    except ValueError as e:
+        parser.error(str(e))
+
+    app = App(args.width, args.height, canvas_divisions=args.canvas_divisions, calibration_dots=args.calibration_dots, port=args.port, trace_path=args.trace, tracking_profiler=tracking_profiler, gui_profiler=gui_profiler,
+              user=args.user, profile_dir=args.profile_dir, recalibrate=args.recalibrate, drift_threshold=args.drift_threshold,
+              adaptive=args.adaptive, target_error=args.target_error, mock_tracking=args.mock_tracking, display=args.display)    # Initialize the app at a size of 1600 pixels wide and 900 pixels high
     app.execute()   # Start the program
@@ -8,6 +8,9 @@ import pygame
 import enum
 import math
 import argparse
+import logging
+import json
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -15,8 +18,9 @@ import pandas as pd
 import random
 from sklearn import linear_model
 
-from eyelib import GazeEstimationThread, GazeState
+from eyelib import GazeEstimationThread, GazeState, RecursiveLeastSquares, JointPolynomialModel, create_frame_source
 from eyelib import CalibrationDot, ProgramState
+from eyelib import tracer, create_profilers
 
 class MockGazeEstimationThread():
     def get(self):
@@ -71,31 +75,42 @@ def generate_report(experiment_name, percent_correct, time_data, accuracy_data,
     report_text += "Samples: " + str(len(accuracy_data)) + "\n"
     report_text += create_stats_report(accuracy_avg, accuracy_min, accuracy_first_quartile, accuracy_median, accuracy_third_quartile, accuracy_max)
 
-    # Calibration X data processing
-    report_text += "--- Calibration X Data ---\n"
-    calibration_x_first_quartile, calibration_x_median, calibration_x_third_quartile = np.percentile(calibration_x_data, [25, 50, 75])
-    calibration_x_min, calibration_x_max = min(calibration_x_data), max(calibration_x_data)
-    calibration_x_avg = sum(calibration_x_data) / len(calibration_x_data)
+    # Calibration data is empty when there were too few samples for the cross-validated error
+    if len(calibration_x_data) == 0 or len(calibration_y_data) == 0:
+        report_text += "--- Calibration Data ---\nNo calibration error was recorded\n\n"
+    else:
+        # Calibration X data processing
+        report_text += "--- Calibration X Data ---\n"
+        calibration_x_first_quartile, calibration_x_median, calibration_x_third_quartile = np.percentile(calibration_x_data, [25, 50, 75])
+        calibration_x_min, calibration_x_max = min(calibration_x_data), max(calibration_x_data)
+        calibration_x_avg = sum(calibration_x_data) / len(calibration_x_data)
 
-    report_text += "Samples: " + str(len(calibration_x_data)) + "\n"
-    report_text += create_stats_report(calibration_x_avg, calibration_x_min, calibration_x_first_quartile, calibration_x_median, calibration_x_third_quartile, calibration_x_max)
+        report_text += "Samples: " + str(len(calibration_x_data)) + "\n"
+        report_text += create_stats_report(calibration_x_avg, calibration_x_min, calibration_x_first_quartile, calibration_x_median, calibration_x_third_quartile, calibration_x_max)
 
-    # Calibration Y data processing
-    report_text += "--- Calibration Y Data ---\n"
-    calibration_y_first_quartile, calibration_y_median, calibration_y_third_quartile = np.percentile(calibration_y_data, [25, 50, 75])
-    calibration_y_min, calibration_y_max = min(calibration_y_data), max(calibration_y_data)
-    calibration_y_avg = sum(calibration_y_data) / len(calibration_y_data)
+        # Calibration Y data processing
+        report_text += "--- Calibration Y Data ---\n"
+        calibration_y_first_quartile, calibration_y_median, calibration_y_third_quartile = np.percentile(calibration_y_data, [25, 50, 75])
+        calibration_y_min, calibration_y_max = min(calibration_y_data), max(calibration_y_data)
+        calibration_y_avg = sum(calibration_y_data) / len(calibration_y_data)
 
-    report_text += "Samples: " + str(len(calibration_y_data)) + "\n"
-    report_text += create_stats_report(calibration_y_avg, calibration_y_min, calibration_y_first_quartile, calibration_y_median, calibration_y_third_quartile, calibration_y_max)
+        report_text += "Samples: " + str(len(calibration_y_data)) + "\n"
+        report_text += create_stats_report(calibration_y_avg, calibration_y_min, calibration_y_first_quartile, calibration_y_median, calibration_y_third_quartile, calibration_y_max)
 
     with open(experiment_name + "_report.txt", "w") as fp:
         fp.write(report_text)
 
 
 class App():
-    def __init__(self, width, height, canvas_divisions=7, calibration_dots=4, trial_name="test", trial_runs=50):
+    def __init__(self, width, height, canvas_divisions=7, calibration_dots=4, trial_name="test", trial_runs=50, source=None, display="debug", stats_interval=10, trace_path=None, tracking_profiler=None, gui_profiler=None, estimator="linear", cv_folds=None):
         self._running = True
+        self.gui_profiler = gui_profiler
+
+        # With a trace path, frames are traced from capture to the GUI and exported on exit
+        self.trace_path = trace_path
+        if trace_path is not None:
+            tracer.enable()
+
         self._screen = None
         self.size = self.width, self.height = width, height     # Hardcoded dimensions for the window
         
@@ -135,13 +150,25 @@ class App():
         # Object that runs the gaze estimation in a separate thread
         # Deposits predictions into a queue that can be accessed through get()
         
-        self.gaze_estimation = GazeEstimationThread(x_estimator=linear_model.LinearRegression(),
-                                                    y_estimator=linear_model.LinearRegression(),
+        # "rls" updates the regression with every calibration sample instead of refitting it after each one
+        # "joint" fits both axes together with a quadratic in every feature, in place of the two estimators
+        create_estimator = RecursiveLeastSquares if estimator == "rls" else linear_model.LinearRegression
+        joint = estimator == "joint"
+
+        self.gaze_estimation = GazeEstimationThread(x_estimator=None if joint else create_estimator(),
+                                                    y_estimator=None if joint else create_estimator(),
                                                     face_cascade_path="./classifiers/haarcascade_frontalface_default.xml",
                                                     eye_cascade_path="./classifiers/haarcascade_eye.xml",
                                                     shape_predictor_path="./classifiers/shape_predictor_68_face_landmarks.dat",
                                                     width=self.width,
-                                                    height=self.height)
+                                                    height=self.height,
+                                                    source=source,
+                                                    display=display,
+                                                    stats_path=trial_name + "_latency.json",
+                                                    stats_interval=stats_interval,
+                                                    profiler=tracking_profiler,
+                                                    cv_folds=cv_folds,
+                                                    joint_model=JointPolynomialModel() if joint else None)
     
     def init(self):
         pygame.init()   # Init pygame stuff
@@ -178,6 +205,10 @@ class App():
 
         if gaze_location != None:   # If there was a location, update the classes known location
             self.gaze_state = gaze_location
+
+            if tracer.enabled and gaze_location.trace_id is not None:
+                tracer.point("gui_gaze", gaze_location.trace_id, "f", "frame",
+                             {"trace_id": gaze_location.trace_id, "latency_ms": (time.perf_counter() - gaze_location.capture_time) * 1000})
         
         if self.gaze_state == None and self.state != ProgramState.Calibration:
             return
@@ -253,6 +284,14 @@ class App():
     def cleanup(self):
         pygame.quit()   # Quit pygame stuff
 
+        self.gaze_estimation.release()  # Stops tracking, which also writes its profile if one is running
+
+        if self.gui_profiler is not None:
+            self.gui_profiler.finish()
+
+        if self.trace_path is not None:
+            tracer.export(self.trace_path)  # Open in chrome://tracing or ui.perfetto.dev
+
     def execute(self):
         """
         Main loop method of the program
@@ -268,11 +307,17 @@ class App():
             self.loop()         # Call loop method that updates the logic of the program
             self.render()       # Render method that clears screen and redraws buttons
 
+            if self.gui_profiler is not None:
+                self.gui_profiler.tick()
+
             pygame.time.delay(30)   # Delay to run at about 60 updates per second
         
         calibration_x_data, calibration_y_data = self.gaze_estimation.get_calibration_samples()
         generate_report(self.trial_name, self.correct / self.trial_runs, self.gaze_estimation.get_time_samples(), self.accuracy_data, calibration_x_data, calibration_y_data)
 
+        with open(self.trial_name + '_latency.json', 'w') as f:
+            json.dump(self.gaze_estimation.get_latency_snapshot(), f, indent=2)    # Final per-stage latencies for the whole trial
+
         sns.histplot(self.accuracy_data).set_title("Accuracy")
         plt.savefig(self.trial_name + '_accuracy_histogram.png')
         plt.clf()
@@ -317,8 +362,35 @@ if __name__ == "__main__":
     parser.add_argument("--test_divisions", type=int, default=8, help="Number divisions for the testing grid")
     parser.add_argument("--trial_runs", type=int, default=50, help="Number of samples to take during trial")
     parser.add_argument("--calibration_dots", type=int, default=4, help="Width and height of calibration dot matrix")
+    parser.add_argument("--source", type=str, default="0", help="Camera index, video file, image directory or .npy/.raw frame dump to read frames from")
+    parser.add_argument("--realtime", action="store_true", help="Replay recorded sources at their recorded timing instead of as fast as possible")
+    parser.add_argument("--frame_shape", type=int, nargs=3, default=None, help="Height, width and channels of each frame in a .raw dump")
+    parser.add_argument("--fps", type=int, default=30, help="Frame rate of image directory and frame dump sources")
+    parser.add_argument("--display", type=str, default="debug", choices=["debug", "headless"], help="Show the rate-limited tracking overlay or run without a window")
+    parser.add_argument("--estimator", type=str, default="linear", choices=["linear", "rls", "joint"], help="Batch least squares refit per sample, online recursive least squares, or a joint quadratic model of both axes")
+    parser.add_argument("--cv_folds", type=int, default=None, help="Report k-fold instead of leave-one-out calibration error")
+    parser.add_argument("--profile", type=str, default=None, choices=["cprofile", "sample"], help="Profile with cProfile (pstats output) or the sampling profiler (collapsed stacks)")
+    parser.add_argument("--profile_scope", type=str, default="both", choices=["tracking", "gui", "both"], help="Which loop to profile, on Python 3.12+ cprofile can only profile one of them")
+    parser.add_argument("--profile_duration", type=float, default=None, help="Stop profiling after this many seconds")
+    parser.add_argument("--profile_frames", type=int, default=None, help="Stop profiling after this many loop iterations")
+    parser.add_argument("--profile_output", type=str, default="profile", help="Prefix for profile files, written as <prefix>_tracking and <prefix>_gui")
+    parser.add_argument("--trace", type=str, default=None, help="Record a Chrome trace event JSON file of frame latencies to this path")
+    parser.add_argument("--stats_interval", type=float, default=10, help="Seconds between per-stage latency snapshots written to <trial_name>_latency.json")
 
     args = parser.parse_args()
 
-    app = App(args.width, args.height, canvas_divisions=args.test_divisions, calibration_dots=args.calibration_dots, trial_name=args.trial_name, trial_runs=args.trial_runs)    # Initialize the app at a size of 1600 pixels wide and 900 pixels high
+    try:
+        tracking_profiler, gui_profiler = create_profilers(args.profile, args.profile_scope, args.profile_output, args.profile_duration, args.profile_frames)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.profile is not None:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")   # Shows where the profiles were written
+
+    try:
+        source = create_frame_source(args.source, realtime=args.realtime, frame_shape=args.frame_shape, fps=args.fps)
+    except ValueError as e:
+        parser.error(str(e))
+
+    app = App(args.width, args.height, canvas_divisions=args.test_divisions, calibration_dots=args.calibration_dots, trial_name=args.trial_name, trial_runs=args.trial_runs, source=source, display=args.display, stats_interval=args.stats_interval, trace_path=args.trace, tracking_profiler=tracking_profiler, gui_profiler=gui_profiler, estimator=args.estimator, cv_folds=args.cv_folds)    # Initialize the app at a size of 1600 pixels wide and 900 pixels high
     app.execute()   # Start the program
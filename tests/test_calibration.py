@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from eyelib.Calibration import AdaptiveCalibration
+from eyelib.GazeEstimation import GazeEstimation
+
+@pytest.mark.parametrize("worst", range(5))
+def test_adaptive_calibration_moves_towards_the_worst_dot(worst):
+    calibration = AdaptiveCalibration(1600, 900, 4)
+    points = np.array([calibration.next_point() for _ in range(5)])
+
+    residuals = np.full(len(points), 5.0)
+    residuals[worst] = 100
+
+    calibration.add_error(40, points, residuals)
+    x, y = calibration.next_point()
+
+    # The next dot is one grid cell from the worst one, 400 by 225 pixels on a 4 by 4 grid
+    assert abs(x - points[worst, 0]) <= 400 and abs(y - points[worst, 1]) <= 225
+
+def test_residuals_are_reported_per_dot():
+    rng = np.random.default_rng(0)
+    estimation = GazeEstimation(LinearRegression(), LinearRegression(), 1600, 900)
+
+    assert estimation.get_residuals() == (None, None)
+
+    for _ in range(8):
+        features = rng.uniform(0, 1, 4)
+        estimation.add_sample(features, (features[0] * 1600, features[1] * 900))
+
+    error = estimation.test_data()
+    points, residuals = estimation.get_residuals()
+
+    assert points.shape == (8, 2) and residuals.shape == (8,)
+    assert np.sqrt(np.mean(residuals ** 2)) == pytest.approx(error)
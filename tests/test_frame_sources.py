@@ -0,0 +1,14 @@
+import numpy as np
+import pytest
+
+from eyelib.FrameSources import RawFrameSource
+
+def test_raw_dump_needs_frame_shape(tmp_path):
+    path = str(tmp_path / "frames.raw")
+    np.zeros((2, 4, 6, 3), dtype=np.uint8).tofile(path)
+
+    with pytest.raises(ValueError, match="frame_shape"):
+        RawFrameSource(path)
+
+    source = RawFrameSource(path, frame_shape=(4, 6, 3))
+    assert source.get_size() == (6, 4)
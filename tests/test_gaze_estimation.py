@@ -0,0 +1,50 @@
+import logging
+
+import numpy as np
+from sklearn.linear_model import LinearRegression, Ridge
+
+from eyelib.GazeEstimation import GazeEstimation, get_ridge_penalty
+from eyelib.OnlineRegression import RecursiveLeastSquares
+
+def make_estimation(rng, samples):
+    estimation = GazeEstimation(LinearRegression(), LinearRegression(), 1600, 900)
+
+    for _ in range(samples):
+        features = rng.uniform(0, 1, 4)
+        estimation.add_sample(features, (features[0] * 1600, features[1] * 900))
+
+    return estimation
+
+def test_ridge_penalty_only_for_unweighted_least_squares():
+    assert get_ridge_penalty(LinearRegression()) == 0
+    assert get_ridge_penalty(Ridge(alpha=2.0)) == 2.0
+    assert get_ridge_penalty(RecursiveLeastSquares()) == 0
+    assert get_ridge_penalty(RecursiveLeastSquares(forgetting_factor=0.95)) is None
+    assert get_ridge_penalty(LinearRegression(fit_intercept=False)) is None
+
+def test_profile_round_trip_refits_the_same_model(tmp_path):
+    rng = np.random.default_rng(0)
+    estimation = make_estimation(rng, 12)
+    estimation.train()
+
+    path = str(tmp_path / "user.npz")
+    estimation.save_profile(path, "camera")
+
+    loaded = GazeEstimation(LinearRegression(), LinearRegression(), 1600, 900)
+    assert loaded.load_profile(path, "camera")
+
+    features = rng.uniform(0, 1, 4)
+    np.testing.assert_allclose(loaded.predict_into(features, np.empty(2)), estimation.predict_into(features, np.empty(2)))
+
+def test_profile_mismatch_is_logged(tmp_path, caplog):
+    estimation = make_estimation(np.random.default_rng(1), 12)
+
+    path = str(tmp_path / "user.npz")
+    estimation.save_profile(path, "camera")
+
+    with caplog.at_level(logging.INFO, logger="eyelib.GazeEstimation"):
+        assert not GazeEstimation(LinearRegression(), LinearRegression(), 1280, 720).load_profile(path, "camera")
+        assert not estimation.load_profile(path, "other camera")
+
+    assert "1600x900 screen" in caplog.text
+    assert "made with camera camera" in caplog.text
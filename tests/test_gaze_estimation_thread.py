@@ -0,0 +1,69 @@
+import threading
+import time
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+
+from eyelib.GazeEstimation import GazeEstimation
+from eyelib.GazeEstimationThread import GazeEstimationThread
+
+def make_pacer(cpu_budget):
+    # Only the fields _pace reads, so no camera or models are needed
+    pacer = GazeEstimationThread.__new__(GazeEstimationThread)
+    pacer._min_period = 0.001
+    pacer._cpu_budget = cpu_budget
+    pacer._active = True
+    pacer._idle_timeout = 60
+    pacer._idle_interval = pacer._min_period
+    pacer._max_idle_interval = 0.5
+    pacer._last_consumer_time = time.perf_counter()
+    pacer._idling = False
+    pacer._wake = threading.Event()
+
+    return pacer
+
+def spin(duration):
+    end_time = time.perf_counter() + duration
+    while time.perf_counter() < end_time:
+        pass
+
+def get_pace_delay(pacer, wait, work):
+    start_time = time.time()
+    start_cpu_time = time.thread_time()
+
+    time.sleep(wait)    # Blocked on the next frame
+    spin(work)
+
+    pace_start = time.perf_counter()
+    pacer._pace(start_time, start_cpu_time)
+
+    return time.perf_counter() - pace_start
+
+def test_cpu_budget_ignores_time_waiting_for_frames():
+    # 10 ms of work in a 30 ms iteration already uses less than half a core
+    assert get_pace_delay(make_pacer(0.5), 0.02, 0.01) < 0.005
+
+def test_cpu_budget_throttles_busy_loops():
+    # 20 ms of work with no waiting needs another 20 ms of sleep to stay at half a core
+    assert get_pace_delay(make_pacer(0.5), 0, 0.02) > 0.012
+
+def test_drift_is_measured_on_the_robust_mean_of_settled_frames():
+    rng = np.random.default_rng(0)
+    estimation = GazeEstimation(LinearRegression(), LinearRegression(), 1600, 900)
+    for _ in range(12):
+        features = rng.uniform(0, 1, 4)
+        estimation.add_sample(features, (features[0] * 1600, features[1] * 900))
+    estimation.train()
+
+    tracker = make_pacer(1.0)
+    tracker._gaze_estimator = estimation
+
+    settled = np.array([0.5, 0.5, 0.3, 0.7])
+    blink = np.zeros(4)
+
+    tracker.start_sample()
+    for frame in range(20):
+        tracker._features = (blink if frame == 19 else settled + rng.normal(0, 1e-3, 4), frame)
+        tracker._collected.append(tracker._features[0])
+
+    assert tracker.measure_drift((800, 450)) < 5     # The blink on the last frame is left out
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from eyelib.GazeFilter import FixationDetector, OneEuroFilter
+
+def get_fixation_events(seed, centers=((400, 300), (1200, 600)), frames=60):
+    """
+    Runs noisy gaze with occasional glitches, held on each center for frames frames at 30 fps, through the filter and
+    detector the tracking thread uses, and returns the events
+    """
+
+    rng = np.random.default_rng(seed)
+    gaze_filter = OneEuroFilter()
+    detector = FixationDetector()
+
+    events = []
+    timestamp = 0
+
+    for center_x, center_y in centers:
+        for frame in range(frames):
+            timestamp += 1 / 30
+            point = np.array([center_x + rng.normal(0, 12), center_y + rng.normal(0, 12)])
+
+            if rng.uniform() < 0.06:
+                point[0] += rng.uniform(-150, 150)
+
+            x, y = gaze_filter.filter(point, timestamp)
+            event = detector.update(x, y, timestamp, frame)
+
+            if event is not None:
+                events.append(event)
+
+    return events, detector
+
+@pytest.mark.parametrize("seed", range(10))
+def test_noise_does_not_split_fixations(seed):
+    events, detector = get_fixation_events(seed)
+
+    assert [event.ended for event in events] == [False, True, False]
+    assert events[1].x == pytest.approx(400, abs=10) and events[1].y == pytest.approx(300, abs=10)
+    assert np.hypot(events[2].x - 1200, events[2].y - 600) <= detector.max_distance
+
+def test_state_does_not_grow_with_fixation_length():
+    _, detector = get_fixation_events(0, centers=((400, 300),), frames=5000)
+
+    # Nothing the detector keeps holds more than the pending outliers
+    assert all(len(value) < detector.exit_points for value in vars(detector).values() if isinstance(value, list))
+    assert detector.get_duration() > 0
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from eyelib.OnlineRegression import RecursiveLeastSquares
+
+def make_samples(rng, count):
+    features = rng.uniform(0, 1, (count, 2))
+    targets = features @ [0.8, -0.3] + 0.2 + rng.normal(0, 0.01, count)
+
+    return features, targets
+
+def test_matches_least_squares():
+    features, targets = make_samples(np.random.default_rng(0), 40)
+
+    online = RecursiveLeastSquares()
+    for row, target in zip(features, targets):
+        online.partial_fit(row.reshape(1, -1), [target])
+
+    batch = LinearRegression().fit(features, targets)
+
+    np.testing.assert_allclose(online.coef_, batch.coef_, atol=1e-6)
+    assert online.intercept_ == pytest.approx(batch.intercept_, abs=1e-6)
+    np.testing.assert_allclose(online.predict(features), batch.predict(features), atol=1e-6)
+
+def test_reset_forgets_every_sample():
+    rng = np.random.default_rng(1)
+    first_features, first_targets = make_samples(rng, 20)
+    features, targets = make_samples(rng, 20)
+
+    online = RecursiveLeastSquares().partial_fit(first_features, -first_targets)
+    online.reset()
+    online.partial_fit(features, targets)
+
+    fresh = RecursiveLeastSquares().partial_fit(features, targets)
+
+    np.testing.assert_allclose(online.coef_, fresh.coef_)
+    assert online.intercept_ == pytest.approx(fresh.intercept_)
+
+def test_forgetting_matches_exponentially_weighted_least_squares():
+    features, targets = make_samples(np.random.default_rng(2), 40)
+    targets[:20] += 0.5     # The mapping drifts halfway through
+
+    online = RecursiveLeastSquares(forgetting_factor=0.9).partial_fit(features, targets)
+    weights = 0.9 ** np.arange(len(targets) - 1, -1, -1)
+    batch = LinearRegression().fit(features, targets, sample_weight=weights)
+
+    np.testing.assert_allclose(online.coef_, batch.coef_, atol=1e-6)
+    assert online.intercept_ == pytest.approx(batch.intercept_, abs=1e-6)
+    assert online.intercept_ == pytest.approx(0.2, abs=0.05)    # Follows the drift
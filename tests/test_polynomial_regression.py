@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from eyelib.GazeEstimation import GazeEstimation, cross_validation_residuals
+from eyelib.PolynomialRegression import JointPolynomialModel, get_loo_errors
+
+def make_calibration(rng, count, tilt=0.02):
+    """
+    Pupil positions of both eyes for gaze points spread over the screen, with the head slightly tilted so the axes mix
+    """
+
+    gaze = rng.uniform(0, 1, (count, 2))
+    features = np.column_stack((0.4 + 0.2 * gaze[:, 0] + tilt * gaze[:, 1], 0.4 + 0.15 * gaze[:, 1] - tilt * gaze[:, 0],
+                                0.5 + 0.2 * gaze[:, 0] + tilt * gaze[:, 1], 0.4 + 0.15 * gaze[:, 1] - tilt * gaze[:, 0]))
+
+    return features + rng.normal(0, 0.004, features.shape), gaze
+
+def test_loo_errors_match_hat_matrix_residuals():
+    rng = np.random.default_rng(0)
+    terms = rng.normal(size=(12, 5))
+    labels = rng.normal(size=(12, 2))
+
+    residuals = cross_validation_residuals(terms, labels, 0.3)
+
+    assert get_loo_errors(terms, labels, [0.3])[0] == pytest.approx(np.mean(np.sum(residuals ** 2, axis=1)))
+
+@pytest.mark.parametrize("count", [9, 16])
+def test_joint_model_no_worse_than_separate_linear_fits(count):
+    joint_errors = []
+    separate_errors = []
+
+    for seed in range(30):
+        rng = np.random.default_rng(seed)
+        features, labels = make_calibration(rng, count)
+        test_features, test_labels = make_calibration(rng, 200)
+
+        joint = JointPolynomialModel().fit(features, labels)
+        joint_errors.append(np.mean(np.sum((joint.predict(test_features) - test_labels) ** 2, axis=1)))
+
+        x_fit = LinearRegression().fit(features[:, 0::2], labels[:, 0])
+        y_fit = LinearRegression().fit(features[:, 1::2], labels[:, 1])
+        separate_errors.append(np.mean((x_fit.predict(test_features[:, 0::2]) - test_labels[:, 0]) ** 2 +
+                                       (y_fit.predict(test_features[:, 1::2]) - test_labels[:, 1]) ** 2))
+
+    assert np.mean(joint_errors) <= np.mean(separate_errors)
+
+def test_joint_model_does_not_interpolate_small_calibrations():
+    rng = np.random.default_rng(3)
+    features, labels = make_calibration(rng, 9)
+
+    model = JointPolynomialModel()
+    assert model.select(features, labels)[0] == 1   # Degree 2 has 15 parameters
+
+    estimation = GazeEstimation(None, None, 1600, 900, joint_model=model)
+    for feature, label in zip(features, labels):
+        estimation.add_sample(feature, (label[0] * 1600, label[1] * 900))
+
+    assert np.isfinite(estimation.test_data())
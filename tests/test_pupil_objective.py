@@ -0,0 +1,91 @@
+import cv2
+import numpy as np
+import pytest
+
+from eyelib.FeatureExtraction import GradientPreprocessor, PupilDetector, get_pyramid_sizes, score_centers
+from eyelib.FeatureExtraction import test_all_centers as score_all_centers, test_all_centers_fft as score_all_centers_fft
+from eyelib.FeatureExtraction import test_all_centers_reference as score_all_centers_reference
+
+def make_eye_patch(rng, height, width):
+    patch = rng.integers(100, 200, (height, width)).astype(np.uint8)
+    center = (int(rng.integers(width // 4, 3 * width // 4)), int(rng.integers(height // 4, 3 * height // 4)))
+    cv2.circle(patch, center, max(2, min(height, width) // 6), 20, -1)
+
+    return cv2.GaussianBlur(patch, (3, 3), 0)
+
+def make_pupil_crop(center_x, center_y, size=60, radius=9, supersampling=8):
+    """
+    An eye crop with an anti-aliased dark pupil at a sub-pixel center, drawn supersampled and averaged down
+    """
+
+    ys, xs = np.mgrid[0:size * supersampling, 0:size * supersampling]
+    inside = np.hypot((xs + 0.5) / supersampling - 0.5 - center_x, (ys + 0.5) / supersampling - 0.5 - center_y) <= radius
+    crop = np.where(inside, 40, 190).astype(np.uint8)
+
+    return cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA)
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("shape", [(20, 20), (27, 31), (48, 48)])
+def test_fft_backend_matches_direct_argmax(seed, shape):
+    rng = np.random.default_rng(seed)
+    patch = make_eye_patch(rng, *shape) if seed % 2 == 0 else rng.integers(0, 255, shape).astype(np.uint8)
+
+    x_gradients, y_gradients, weights = GradientPreprocessor().process(patch)
+
+    direct = score_all_centers(patch, weights, x_gradients, y_gradients)
+    fft = score_all_centers_fft(patch, weights, x_gradients, y_gradients)
+
+    assert cv2.minMaxLoc(fft)[3] == cv2.minMaxLoc(direct)[3]
+    assert fft.max() == pytest.approx(direct.max(), rel=1e-12)
+
+@pytest.mark.parametrize("seed", range(30))
+def test_vectorized_objective_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    shape = [(10, 10), (12, 9), (14, 14)][seed % 3]
+    patch = make_eye_patch(rng, *shape)
+
+    x_gradients, y_gradients, weights = GradientPreprocessor().process(patch)
+
+    reference = score_all_centers_reference(patch, weights, x_gradients, y_gradients)
+    vectorized = score_all_centers(patch, weights, x_gradients, y_gradients)
+
+    assert cv2.minMaxLoc(vectorized)[3] == cv2.minMaxLoc(reference)[3]
+    np.testing.assert_allclose(vectorized, reference, rtol=1e-9, atol=1e-12)
+
+def test_fft_backend_bounds_the_objective():
+    rng = np.random.default_rng(0)
+    patch = make_eye_patch(rng, 24, 24)
+
+    x_gradients, y_gradients, weights = GradientPreprocessor().process(patch)
+
+    direct = score_all_centers(patch, weights, x_gradients, y_gradients)
+    fft = score_all_centers_fft(patch, weights, x_gradients, y_gradients)
+
+    assert np.all(fft >= direct - 1e-9 * direct.max())
+
+def test_score_centers_matches_full_map():
+    rng = np.random.default_rng(1)
+    patch = make_eye_patch(rng, 16, 16)
+
+    x_gradients, y_gradients, weights = GradientPreprocessor().process(patch)
+    direct = score_all_centers(patch, weights, x_gradients, y_gradients)
+
+    center_xs = np.array([0, 5, 15])
+    center_ys = np.array([3, 8, 15])
+
+    np.testing.assert_allclose(score_centers(weights, x_gradients, y_gradients, center_xs, center_ys), direct[center_ys, center_xs])
+
+def test_pyramid_reaches_native_crop_size():
+    assert get_pyramid_sizes(20, 200) == [20, 40, 80, 160, 200]
+    assert get_pyramid_sizes(20, 200, levels=3) == [20, 40, 80]
+    assert get_pyramid_sizes(20, 15) == [15]
+
+@pytest.mark.parametrize("center", [(27.3, 31.6), (30.7, 28.2), (25.45, 33.85)])
+def test_pyramid_search_finds_sub_pixel_center(center):
+    crop = make_pupil_crop(*center)
+
+    pyramid_x, pyramid_y = PupilDetector(pupil_search="pyramid")._detect_pupil_pyramid(crop, 20)
+    fixed_x, fixed_y = PupilDetector()._detect_pupil_dot(crop, 20)
+
+    assert np.hypot(pyramid_x - center[0], pyramid_y - center[1]) < 0.25
+    assert np.hypot(pyramid_x - center[0], pyramid_y - center[1]) < np.hypot(fixed_x - center[0], fixed_y - center[1])
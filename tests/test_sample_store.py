@@ -0,0 +1,53 @@
+import numpy as np
+
+from eyelib.SampleStore import SampleStore
+
+def make_batch(start, count, feature_count=4):
+    features = np.arange(start * feature_count, (start + count) * feature_count, dtype=np.double).reshape(count, feature_count)
+    labels = np.column_stack((np.arange(start, start + count), -np.arange(start, start + count))).astype(np.double)
+
+    return features, labels, np.arange(start, start + count) * 0.5, np.arange(start, start + count)
+
+def test_extend_past_capacity_keeps_every_sample():
+    store = SampleStore(capacity=4)
+
+    store.append(*[part[0] for part in make_batch(0, 1)])
+    store.extend(*make_batch(1, 10))    # More than twice the capacity in one batch
+    store.extend(*make_batch(11, 3))
+
+    assert len(store) == 14
+    assert store.get_capacity() == 16
+
+    features, labels, timestamps, frame_ids = make_batch(0, 14)
+    np.testing.assert_array_equal(store.get_features(), features)
+    np.testing.assert_array_equal(store.get_labels(), labels)
+    np.testing.assert_array_equal(store.get_timestamps(), timestamps)
+    np.testing.assert_array_equal(store.get_frame_ids(), frame_ids)
+    np.testing.assert_array_equal(store.get_features(slice(0, None, 2)), features[:, 0::2])
+    np.testing.assert_array_equal(store.get_labels(1), labels[:, 1])
+
+def test_getters_return_views_and_appends_copy():
+    store = SampleStore()
+    buffer = np.array([1.0, 2.0, 3.0, 4.0])
+
+    store.append(buffer, (0.1, 0.2))
+    buffer[:] = 9   # The caller reusing its buffer does not change the stored sample
+
+    np.testing.assert_array_equal(store.get_features()[0], [1.0, 2.0, 3.0, 4.0])
+    # The getters hand out the filled rows of the store's own arrays without copying
+    assert np.shares_memory(store.get_features(), store._features)
+    assert np.shares_memory(store.get_labels(0), store._labels)
+    assert np.shares_memory(store.get_frame_ids(), store._frame_ids)
+
+def test_clear_forgets_samples_and_feature_count():
+    store = SampleStore(capacity=2)
+    store.extend(*make_batch(0, 5))
+
+    store.clear()
+
+    assert len(store) == 0
+    assert store.get_capacity() == 2
+    assert store.get_features().shape == (0, 0)
+
+    store.extend(*make_batch(0, 3, feature_count=6))
+    assert store.get_features().shape == (3, 6)
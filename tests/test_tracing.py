@@ -0,0 +1,34 @@
+from eyelib.Tracing import TraceRecorder
+
+def get_flows(recorder):
+    return [event for event in recorder.get_events() if event["ph"] in ("s", "t", "f")]
+
+def test_flow_points_of_a_kind_share_one_name():
+    recorder = TraceRecorder()
+    recorder.enable()
+
+    with recorder.span("features", "frame", flow=("s", 1)):
+        pass
+
+    recorder.point("gui_gaze", 1, "f", "frame")
+
+    stroke_id = recorder.new_id()
+    with recorder.span("commit_stroke", "stroke", flow=("s", stroke_id)):
+        pass
+
+    with recorder.span("gcode_send", "stroke", flow=("f", stroke_id)):
+        pass
+
+    flows = get_flows(recorder)
+
+    assert {(event["name"], event["cat"]) for event in flows if event["id"] == 1} == {("frame", "frame")}
+    assert {(event["name"], event["cat"]) for event in flows if event["id"] == stroke_id} == {("stroke", "stroke")}
+
+    # The step names stay on the slices
+    assert {event["name"] for event in recorder.get_events() if event["ph"] == "X"} == {"features", "gui_gaze", "commit_stroke", "gcode_send"}
+
+def test_stroke_ids_do_not_overlap_frame_sequences():
+    recorder = TraceRecorder()
+
+    assert recorder.new_id() > 10 ** 9
+    assert recorder.new_id() != recorder.new_id()
@@ -0,0 +1,32 @@
+import time
+
+import pytest
+
+from eyelib.VisionPipeline import VisionPipeline
+
+class DeadCamera():
+    """
+    A live source that never delivers a frame, like a missing or busy camera
+    """
+
+    is_live = True
+    finished = False
+
+    def __init__(self):
+        self.released = False
+
+    def read(self):
+        return False, None
+
+    def release(self):
+        self.released = True
+
+def test_missing_camera_raises_instead_of_hanging():
+    camera = DeadCamera()
+    start_time = time.perf_counter()
+
+    with pytest.raises(RuntimeError):
+        VisionPipeline("face.xml", "eye.xml", "landmarks.dat", source=camera, first_frame_timeout=0.2)
+
+    assert time.perf_counter() - start_time < 2
+    assert camera.released